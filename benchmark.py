@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+
+# wp-md, copyright Brandon W Maister <quodlibetor@gmail.com>
+# Free to use under the MIT license: http://mit-license.org/
+# Homepage: https://github.com/quodlibetor/wp-md
+
+"""Benchmark wp-md against synthetic WordPress exports.
+
+Run ``python benchmark.py --help`` for the knobs. This generates a WXR, a
+PHPMyAdmin xml and a mysqldump export with the requested number and shape of
+posts, then for every input/output format combination it times:
+
+    - the whole ``Exporter`` pipeline, like running ``wp-md`` would
+    - every stage on its own: xml parsing (``get_posts_from_*``),
+      ``_markdownify``, rendering the templates in ``export_to_*`` and
+      writing the files
+
+Every combination is run in fresh processes, so that the peak RSS that gets
+reported belongs to that run alone. Results are printed (or appended to
+``--output``) as one json object per line, so that runs can be compared
+over time.
+
+``--verify`` checks the converter instead: the generated posts and a pile
+of random tag soup go through ``HtmlPreProcessor.convert`` with and without
+its fast paths, and the results have to be identical. It also checks that
+wp-md's command line finds the destination wherever the options are.
+"""
+import sys
+import os
+import re
+import json
+import time
+import codecs
+import random
+import shutil
+import resource
+import platform
+import tempfile
+import argparse
+import subprocess
+from xml.sax.saxutils import escape
+
+import wpmd
+
+INPUT_FORMATS = ('wp_rss', 'pma_xml', 'sql')
+OUTPUT_FORMATS = ('pelican', 'nikola', 'mynt')
+
+TITLE_WORDS = (u"lorem ipsum dolor sit amet consectetur adipiscing elit sed "
+               u"do eiusmod tempor incididunt ut labore et dolore magna "
+               u"aliqua").split()
+# titles stay ascii so that file names don't depend on the locale
+WORDS = TITLE_WORDS + u"caf\xe9 na\xefve r\xe9sum\xe9".split()
+LANGUAGES = ('python', 'ruby', 'bash', 'c', 'javascript')
+INLINE_TAGS = (u'<em>%s</em>', u'<strong>%s</strong>', u'<code>%s</code>',
+               u'<a href="http://example.com/%s" title="%s">%s</a>')
+
+############################################################################
+# synthetic exports
+class PostGenerator(object):
+    """Makes up WordPress posts with a given size and shape
+
+    ``content_size`` is the approximate size of a post body in bytes,
+    ``tag_density`` the fraction of words wrapped in an inline tag and
+    ``pre_frequency`` the chance that a paragraph is followed by a
+    ``<pre lang=...>`` code block. The same seed makes the same posts.
+    """
+    def __init__(self, content_size=2000, tag_density=0.05,
+                 pre_frequency=0.1, seed=0):
+        self.content_size = content_size
+        self.tag_density = tag_density
+        self.pre_frequency = pre_frequency
+        self.random = random.Random(seed)
+
+    def word(self):
+        word = self.random.choice(WORDS)
+        if self.random.random() < self.tag_density:
+            tag = self.random.choice(INLINE_TAGS)
+            return tag % ((word,) * tag.count('%s'))
+        return word
+
+    def content(self):
+        paragraphs = []
+        size = 0
+        while size < self.content_size:
+            paragraph = u' '.join(self.word()
+                                  for _ in range(self.random.randint(20, 80)))
+            if self.random.random() < self.pre_frequency:
+                paragraph += (u'\n\n<pre lang="%s">def f(x):\n'
+                              u'    return x &lt; 2\n</pre>'
+                              % self.random.choice(LANGUAGES))
+            paragraphs.append(paragraph)
+            size += len(paragraph)
+        return u'\n\n'.join(paragraphs)
+
+    def title(self, i):
+        return u'%s %d' % (u' '.join(self.random.sample(TITLE_WORDS, 3)), i)
+
+    @staticmethod
+    def date(i, offset=0):
+        return u'20%02d-%02d-%02d %02d:%02d:00' % (
+            10 + i % 10, i % 12 + 1, i % 28 + 1, offset % 24, i % 60)
+
+def generate_wxr(fh, posts, generator):
+    """Write a WordPress eXtended RSS export with ``posts`` posts to ``fh``
+
+    WXR files don't carry revisions, so there aren't any.
+    """
+    w = lambda text: fh.write(text.encode('utf-8'))
+    w(u'<?xml version="1.0" encoding="UTF-8" ?>\n'
+      u'<rss version="2.0"'
+      u' xmlns:excerpt="http://wordpress.org/export/1.1/excerpt/"'
+      u' xmlns:content="http://purl.org/rss/1.0/modules/content/"'
+      u' xmlns:dc="http://purl.org/dc/elements/1.1/"'
+      u' xmlns:wp="http://wordpress.org/export/1.1/">\n'
+      u'<channel>\n<title>benchmark</title>\n')
+    for i in xrange(1, posts + 1):
+        content = generator.content().replace(u']]>', u']]&gt;')
+        w(u'<item>\n<title>%s</title>\n'
+          u'<dc:creator>admin</dc:creator>\n'
+          u'<content:encoded><![CDATA[%s]]></content:encoded>\n'
+          u'<wp:post_id>%d</wp:post_id>\n'
+          u'<wp:post_date>%s</wp:post_date>\n'
+          u'<wp:status>publish</wp:status>\n'
+          u'<wp:post_type>post</wp:post_type>\n'
+          u'<category domain="category"><![CDATA[cat%d]]></category>\n'
+          u'<category domain="post_tag"><![CDATA[tag%d]]></category>\n'
+          u'</item>\n'
+          % (escape(generator.title(i)), content, i, generator.date(i),
+             i % 5, i % 20))
+    w(u'</channel>\n</rss>\n')
+
+def wp_rows(posts, generator, revisions=0):
+    """Yield the ``(table, {column: value})`` rows of a WordPress database
+    with ``posts`` posts, in the order that a dump would have them
+
+    Every post gets ``revisions`` revisions, which come after all of the
+    posts like they would in a real database.
+    """
+    next_id = posts + 1
+    for i in xrange(1, posts + 1):
+        yield 'wp_posts', dict(
+            ID=i, post_author=1, post_date=generator.date(i),
+            post_content=generator.content(), post_title=generator.title(i),
+            post_status='publish', post_parent=0, post_type='post')
+    for i in xrange(1, posts + 1):
+        for r in xrange(revisions):
+            yield 'wp_posts', dict(
+                ID=next_id, post_author=1,
+                post_date=generator.date(i, r + 1),
+                post_content=generator.content(),
+                post_title=generator.title(i), post_status='inherit',
+                post_parent=i, post_type='revision')
+            next_id += 1
+    for i in xrange(1, posts + 1):
+        yield 'wp_term_relationships', dict(object_id=i,
+                                            term_taxonomy_id=i % 5 + 1)
+        yield 'wp_term_relationships', dict(object_id=i,
+                                            term_taxonomy_id=i % 20 + 6)
+    for t in xrange(1, 26):
+        yield 'wp_term_taxonomy', dict(
+            term_taxonomy_id=t, term_id=t,
+            taxonomy='category' if t <= 5 else 'post_tag')
+    for t in xrange(1, 26):
+        yield 'wp_terms', dict(term_id=t, name='term %d' % t,
+                               slug='term-%d' % t)
+    yield 'wp_users', dict(ID=1, display_name='admin')
+
+def generate_pma_xml(fh, posts, generator, revisions=0):
+    """Write a PHPMyAdmin xml dump with ``posts`` posts to ``fh``"""
+    w = lambda text: fh.write(text.encode('utf-8'))
+    w(u'<?xml version="1.0" encoding="utf-8"?>\n'
+      u'<pma_xml_export version="1.0">\n<database name="wordpress">\n')
+    for table, columns in wp_rows(posts, generator, revisions):
+        w(u'        <table name="%s">\n' % table)
+        for name in sorted(columns):
+            w(u'            <column name="%s">%s</column>\n'
+              % (name, escape(unicode(columns[name]))))
+        w(u'        </table>\n')
+    w(u'</database>\n</pma_xml_export>\n')
+
+# how mysqldump escapes strings
+SQL_ESCAPES = {u'\\': u'\\\\', u"'": u"\\'", u'"': u'\\"', u'\n': u'\\n',
+               u'\r': u'\\r', u'\0': u'\\0', u'\x1a': u'\\Z'}
+SQL_SPECIAL = re.compile(u'[\\\\\'"\n\r\0\x1a]')
+# rows per INSERT statement
+SQL_ROWS_PER_INSERT = 100
+
+def _sql_value(value):
+    if isinstance(value, (int, long)):
+        return unicode(value)
+    return u"'%s'" % SQL_SPECIAL.sub(lambda m: SQL_ESCAPES[m.group()],
+                                     unicode(value))
+
+def generate_sql(fh, posts, generator, revisions=0):
+    """Write a mysqldump of the same database as ``generate_pma_xml`` to
+    ``fh``, with multi-row INSERTs like ``mysqldump --extended-insert``"""
+    w = lambda text: fh.write(text.encode('utf-8'))
+    w(u'-- MySQL dump 10.13\n/*!40101 SET NAMES utf8 */;\n\n')
+    created = set()
+    batch = []
+    def flush():
+        table, names = batch[0][0], sorted(batch[0][1])
+        w(u'INSERT INTO `%s` VALUES %s;\n' % (table, u','.join(
+            u'(%s)' % u','.join(_sql_value(columns[name]) for name in names)
+            for _, columns in batch)))
+        del batch[:]
+    for table, columns in wp_rows(posts, generator, revisions):
+        if batch and (batch[0][0] != table or
+                      len(batch) >= SQL_ROWS_PER_INSERT):
+            flush()
+        if table not in created:
+            created.add(table)
+            w(u'DROP TABLE IF EXISTS `%s`;\nCREATE TABLE `%s` (\n%s,\n'
+              u'  PRIMARY KEY (`%s`)\n) ENGINE=InnoDB DEFAULT CHARSET=utf8;'
+              u'\n' % (table, table, u',\n'.join(
+                  u'  `%s` %s' % (name, u'bigint(20) unsigned NOT NULL'
+                                  if isinstance(columns[name], int)
+                                  else u"longtext NOT NULL DEFAULT ''")
+                  for name in sorted(columns)), sorted(columns)[0]))
+        batch.append((table, columns))
+    if batch:
+        flush()
+
+############################################################################
+# measurements
+class Timer(object):
+    def __enter__(self):
+        self.start = time.time()
+        self.cpu = time.clock()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.time() - self.start
+        self.cpu_seconds = time.clock() - self.cpu
+
+def rates(timer, items, nbytes):
+    seconds = max(timer.seconds, 1e-9)
+    return {'seconds': round(timer.seconds, 6),
+            'cpu_seconds': round(timer.cpu_seconds, 6),
+            'items': items,
+            'bytes': nbytes,
+            'items_per_sec': round(items / seconds, 2),
+            'mb_per_sec': round(nbytes / seconds / 2 ** 20, 3)}
+
+def peak_rss_kb():
+    # linux reports kilobytes, os x bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def _size(text):
+    return len(text.encode('utf-8')) if text else 0
+
+def run_pipeline(source, input_format, output_format, jobs):
+    """Time a complete run, like the wp-md command would do it"""
+    outdir = tempfile.mkdtemp(prefix='wp-md-bench-')
+    try:
+        with Timer() as timer:
+            wpmd.Exporter(source, outdir, input_format, output_format,
+                          jobs=jobs)
+        posts = len(set(os.path.splitext(f)[0] for f in os.listdir(outdir)))
+    finally:
+        shutil.rmtree(outdir)
+    result = rates(timer, posts, os.path.getsize(source))
+    result['peak_rss_kb'] = peak_rss_kb()
+    return result
+
+def run_stages(source, input_format, output_format):
+    """Time every stage of a run on its own"""
+    exporter = wpmd.Exporter.pipeline(output_format)
+    stages = {}
+
+    with Timer() as timer:
+        count = sum(1 for _ in exporter.iter_posts(source, input_format))
+    stages['parse'] = rates(timer, count, os.path.getsize(source))
+
+    posts = [post for post in exporter.iter_posts(source, input_format)
+             if post['content'] is not None]
+    html_bytes = sum(_size(post['content']) for post in posts)
+    with Timer() as timer:
+        for post in posts:
+            post['content'] = exporter._markdownify(post['content'])
+    stages['markdownify'] = rates(timer, len(posts), html_bytes)
+
+    with Timer() as timer:
+        rendered = list(exporter.iter_rendered(posts))
+    rendered_bytes = sum(len(data) for _, data in rendered)
+    stages['render'] = rates(timer, len(rendered), rendered_bytes)
+
+    outdir = tempfile.mkdtemp(prefix='wp-md-bench-')
+    try:
+        sink = wpmd.DirectorySink(outdir)
+        with Timer() as timer:
+            for filename, data in rendered:
+                sink.write(filename, data)
+            sink.close()
+    finally:
+        shutil.rmtree(outdir)
+    stages['write'] = rates(timer, len(rendered), rendered_bytes)
+    stages['peak_rss_kb'] = peak_rss_kb()
+    exporter.close()
+    return stages
+
+def run_case(case):
+    """Run one measurement, in the process that is running this"""
+    # pelican reports every file that it writes
+    stdout = sys.stdout
+    sys.stdout = codecs.getwriter('utf-8')(open(os.devnull, 'w'))
+    try:
+        if case['what'] == 'pipeline':
+            result = run_pipeline(case['source'], case['input_format'],
+                                  case['output_format'], case['jobs'])
+        else:
+            result = run_stages(case['source'], case['input_format'],
+                                case['output_format'])
+    finally:
+        sys.stdout = stdout
+    print json.dumps(result)
+
+def measure(**case):
+    """Run one measurement in a fresh python process"""
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                              '--case', json.dumps(case)],
+                             stdout=subprocess.PIPE)
+    out = child.communicate()[0]
+    if child.returncode:
+        raise SystemExit("benchmark case failed: %r" % case)
+    return json.loads(out.splitlines()[-1])
+
+############################################################################
+# checking the converter's fast paths
+
+# what the random posts for --verify are made of, half of them only use
+# the markup that the fast paths handle
+SIMPLE_FUZZ = (u'lorem', u'caf\xe9', u' ', u'  ', u'\t', u'\n', u'\n\n',
+               u'\n\n\n', u'>', u'"', u'<p>', u'</p>', u'<em>', u'</em>',
+               u'<i>', u'</i>', u'<strong>', u'</strong>', u'<b>', u'</b>',
+               u'<code>', u'</code>', u'<a href="http://example.com/">',
+               u'<a href="/x" title="an x">', u'<a title="" href="">', u'</a>',
+               u'<p class="intro">')
+FUZZ = SIMPLE_FUZZ + (u'<em >', u'<br>', u'<br />', u'<ul>', u'<li>',
+                      u'</ul>', u'&amp;', u'&#8217;', u'<EM>', u'<!-- x -->')
+
+def fuzz_content(rand):
+    pieces = rand.choice((SIMPLE_FUZZ, FUZZ))
+    return u''.join(rand.choice(pieces) for _ in xrange(rand.randint(0, 40)))
+
+def _convert(processor, html, fast):
+    """Convert ``html``, or say how converting it blew up"""
+    try:
+        return processor.convert(html, fast)
+    except Exception as e:
+        return type(e).__name__, 'error'
+
+def verify_fast_paths(contents):
+    """Check that the fast paths in ``HtmlPreProcessor.convert`` come up
+    with the same markdown that HTMLParser does
+
+    Returns how many conversions took each path, and the html that came out
+    differently.
+    """
+    paths = {}
+    mismatches = []
+    for html in contents:
+        for md_interpreter in ('markdown', 'misaka'):
+            # a processor remembers the last link it saw, so both of them
+            # have to start out fresh for stray </a>s to come out the same
+            slow, _ = _convert(wpmd.HtmlPreProcessor(md_interpreter), html,
+                               False)
+            fast, path = _convert(wpmd.HtmlPreProcessor(md_interpreter), html,
+                                  True)
+            paths[path] = paths.get(path, 0) + 1
+            if fast != slow:
+                mismatches.append(html)
+    return paths, mismatches
+
+# command lines for --verify, and the sources, destination and formats that
+# wp-md has to make of them wherever the options are
+COMMAND_LINES = [
+    ('src.xml out', ['src.xml'], 'out', 'pelican', 'wp_rss'),
+    ('src.xml --of mynt out', ['src.xml'], 'out', 'mynt', 'wp_rss'),
+    ('a.xml b.xml --if pma_xml out', ['a.xml', 'b.xml'], 'out', 'pelican',
+     'pma_xml'),
+    ('a.xml --of jsonl --keep-html -', ['a.xml'], '-', 'jsonl', 'wp_rss'),
+    ('--of nikola a.xml --if sql b.sql out', ['a.xml', 'b.sql'], 'out',
+     'nikola', 'sql'),
+    ('--plan a.xml b.xml', ['a.xml', 'b.xml'], None, 'pelican', 'wp_rss'),
+    ]
+
+def verify_command_lines():
+    """Check that ``wpmd.parse_args`` tells the sources from the destination
+    in ``COMMAND_LINES``, and return the ones that it gets wrong"""
+    wrong = []
+    for line, sources, dest, output_format, input_format in COMMAND_LINES:
+        try:
+            args = wpmd.parse_args(['wp-md'] + line.split())
+        except SystemExit: # argparse already said what it didn't like
+            wrong.append(line)
+            continue
+        if ((args.source, args.dest, args.output_format, args.input_format)
+                != (sources, dest, output_format, input_format)):
+            wrong.append(line)
+    return wrong
+
+############################################################################
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Measure how fast wp-md converts synthetic WordPress "
+        "exports.")
+    parser.add_argument('--posts', type=int, default=1000,
+                        help="How many posts to generate. (Default: 1000)")
+    parser.add_argument('--content-size', type=int, default=2000,
+                        metavar='BYTES',
+                        help="Approximate size of every post body. "
+                        "(Default: 2000)")
+    parser.add_argument('--tag-density', type=float, default=0.05,
+                        help="Fraction of words that are wrapped in an "
+                        "inline tag. (Default: 0.05)")
+    parser.add_argument('--pre-frequency', type=float, default=0.1,
+                        help="Chance that a paragraph is followed by a "
+                        "<pre lang=...> block. (Default: 0.1)")
+    parser.add_argument('--revisions', type=int, default=0,
+                        help="Revisions per post in the pma_xml and sql "
+                        "exports, WXR files don't have them. (Default: 0)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--if', '--input-format', dest='input_formats',
+                        action='append', choices=INPUT_FORMATS,
+                        help="Only benchmark this input format, can be "
+                        "given more than once. (Default: all of them)")
+    parser.add_argument('--of', '--output-format', dest='output_formats',
+                        action='append', choices=OUTPUT_FORMATS,
+                        help="Only benchmark this output format, can be "
+                        "given more than once. (Default: all of them)")
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help="Passed on to the Exporter for the pipeline "
+                        "runs. (Default: 1)")
+    parser.add_argument('--output', metavar='results.jsonl',
+                        help="Append results to this file instead of "
+                        "printing them.")
+    parser.add_argument('--keep', metavar='DIR',
+                        help="Generate the exports into DIR and keep them, "
+                        "instead of using a temporary directory.")
+    parser.add_argument('--verify', action='store_true',
+                        help="Don't time anything, check that the "
+                        "converter's fast paths give the same results as "
+                        "the slow one on the generated posts and --posts x "
+                        "10 random ones, and that wp-md parses its command "
+                        "lines right.")
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    return parser.parse_args(args[1:])
+
+def verify(args):
+    generator = PostGenerator(args.content_size, args.tag_density,
+                              args.pre_frequency, args.seed)
+    rand = random.Random(args.seed)
+    contents = [generator.content() for _ in xrange(args.posts)]
+    contents.extend(fuzz_content(rand) for _ in xrange(args.posts * 10))
+    paths, mismatches = verify_fast_paths(contents)
+    command_lines = verify_command_lines()
+    print json.dumps({'paths': paths, 'mismatches': len(mismatches),
+                      'command_line_mismatches': len(command_lines)},
+                     sort_keys=True)
+    for html in mismatches[:10]:
+        sys.stderr.write('mismatch: %r\n' % html)
+    for line in command_lines:
+        sys.stderr.write('command line parsed wrong: wp-md %s\n' % line)
+    if mismatches or command_lines:
+        sys.exit(1)
+
+def main():
+    args = parse_args(sys.argv)
+    if args.case:
+        return run_case(json.loads(args.case))
+    if args.verify:
+        return verify(args)
+
+    workdir = args.keep or tempfile.mkdtemp(prefix='wp-md-bench-')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    params = dict((name, getattr(args, name)) for name in
+                  ('posts', 'content_size', 'tag_density', 'pre_frequency',
+                   'revisions', 'seed', 'jobs'))
+    out = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        sources = {}
+        for input_format in args.input_formats or INPUT_FORMATS:
+            generator = PostGenerator(args.content_size, args.tag_density,
+                                      args.pre_frequency, args.seed)
+            source = os.path.join(workdir, 'export-%s%s' % (
+                input_format, wpmd.SOURCE_EXTENSIONS[input_format]))
+            with open(source, 'wb') as fh:
+                if input_format == 'wp_rss':
+                    generate_wxr(fh, args.posts, generator)
+                elif input_format == 'sql':
+                    generate_sql(fh, args.posts, generator, args.revisions)
+                else:
+                    generate_pma_xml(fh, args.posts, generator,
+                                     args.revisions)
+            sources[input_format] = source
+
+        for input_format, source in sorted(sources.items()):
+            for output_format in args.output_formats or OUTPUT_FORMATS:
+                case = dict(source=source, input_format=input_format,
+                            output_format=output_format, jobs=args.jobs)
+                result = {
+                    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'wp_md_version': wpmd.VERSION,
+                    'converter_version': wpmd.CONVERTER_VERSION,
+                    'python': platform.python_version(),
+                    'params': params,
+                    'input_format': input_format,
+                    'output_format': output_format,
+                    'input_bytes': os.path.getsize(source),
+                    'pipeline': measure(what='pipeline', **case),
+                    'stages': measure(what='stages', **case),
+                    }
+                out.write(json.dumps(result, sort_keys=True) + '\n')
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if not args.keep:
+            shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
@@ -9,11 +9,13 @@
 The main work in here is done by the Exporter class, which does all the work
 in its ``__init__`` method, which functions as a dispatcher. Create a class
 with the correct arguments and it will do the work, see ``main()`` if you're
-curious.
+curious. To get at the files without writing them anywhere, ``iter_posts``,
+``iter_converted`` and ``iter_rendered`` (or ``Exporter.pipeline()``) are
+the same export as a chain of generators.
 
 The ``HtmlPreProcessor`` class is a stupidly simple HTML->Markdown converter.
-It only converts tags that don't require state-tracking/recursion, and it
-doesn't do all of those. What it *does* do, though, is correctly extract
+It converts simple inline tags, lists and blockquotes, and passes everything
+else through untouched. What it *does* do, though, is correctly extract
 `lang` attributes for syntax-highlighted code blocks, something that I don't
 think any of the other html->md converters do.
 
@@ -23,8 +25,33 @@ probably don't need to deal with it yourself.
 import sys
 import os
 import re
+import json
+import glob
+import bisect
+import time
+import signal
+import errno
+import select
+import hashlib
+import heapq
+import shutil
+import tempfile
+import sqlite3
+import zlib
+import bz2
+import mmap
+import tarfile
+import zipfile
+import socket
+import SocketServer
+from cStringIO import StringIO
+from array import array
 import argparse
-from collections import OrderedDict, defaultdict
+import multiprocessing
+import threading
+import Queue
+from collections import OrderedDict, defaultdict, deque
+from itertools import chain
 from HTMLParser import HTMLParser
 try:
     from xml.etree import cElementTree as ET
@@ -32,9 +59,783 @@ except ImportError:
     from xml.etree import ElementTree as ET
 
 VERSION = '0.1'
+# bump this whenever HtmlPreProcessor's output changes, it invalidates
+# everything that was converted by an older version
+CONVERTER_VERSION = 2
+
+# namespaced elements are expanded according to xml rules to look like
+# '{long/namespace}element', and for some reason I can't create a name
+# mapping inside of etree to allow me to access e.g. wp:element elements.
+# Hence these namespace functions.
+def wp(element):
+    return u'{http://wordpress.org/export/1.1/}%s' % element
+def dc(element):
+    return u'{http://purl.org/dc/elements/1.1/}%s' % element
+def content(el):
+    return u'{http://purl.org/rss/1.0/modules/content/}%s' % el
+
+class Post(object):
+    """A single post, as it goes from an importer to an exporter
+
+    A dict would do, but there's one of these for every post in a blog and
+    the pma_xml importer holds on to all of them at once, so the fields
+    live in slots. It still acts like a dict (``post['title']``,
+    ``post.get(u'id')``, ``template % post``...), and keys that aren't
+    fields end up in an ordinary dict on the side, so importers, exporters
+    and subclasses can keep treating it as one.
+    """
+    FIELDS = ('id', 'date', 'author', 'content', 'title', 'status',
+              'post_type', 'tags', 'categories', 'classifiers', 'revision_of',
+              'comments',
+              # filled in by the exporters
+              'slug', 'category', 'safe_title')
+    __slots__ = FIELDS + ('_extra',)
+
+    def __init__(self, **fields):
+        self._extra = None
+        for key, value in fields.iteritems():
+            setattr(self, key, value)
+
+    def __getitem__(self, key):
+        if key in _POST_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in _POST_FIELDS:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _POST_FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        if key in _POST_FIELDS:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, fields):
+        for key, value in dict(fields).iteritems():
+            self[key] = value
+
+    def keys(self):
+        keys = [name for name in self.FIELDS if hasattr(self, name)]
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if not isinstance(other, Post):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        return dict(self.items())
+
+    def __setstate__(self, state):
+        self._extra = None
+        for key, value in state.iteritems():
+            self[key] = value
+
+    def __repr__(self):
+        return 'Post(%r)' % dict(self.items())
+
+_POST_FIELDS = frozenset(Post.FIELDS)
+
+# the path to a post in a WXR file, relative to the root <rss> element
+WXR_ITEM = ('channel', 'item')
+# ...and to one of its comments
+WXR_COMMENT = WXR_ITEM + (wp('comment'),)
+
+# how much compressed input gets read at a time
+READ_SIZE = 64 * 1024
+
+def _new_gzip_decompressor():
+    # 16 tells zlib to expect a gzip header
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def _new_xz_decompressor():
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise IOError("This source is xz compressed, reading it needs "
+                          "python 3's lzma module or backports.lzma")
+    return lzma.LZMADecompressor()
+
+def _new_zstd_decompressor():
+    try:
+        import zstandard
+    except ImportError:
+        raise IOError("This source is zstd compressed, reading it needs the "
+                      "zstandard module")
+    return zstandard.ZstdDecompressor().decompressobj()
+
+# magic bytes -> a function that creates a decompressor for them
+COMPRESSIONS = (
+    ('\x1f\x8b', _new_gzip_decompressor),
+    ('BZh', bz2.BZ2Decompressor),
+    ('\xfd7zXZ\x00', _new_xz_decompressor),
+    ('\x28\xb5\x2f\xfd', _new_zstd_decompressor),
+    )
+
+class _DecompressingReader(object):
+    """A file-like object that decompresses ``fh`` as it's read
+
+    Only ``read`` is supported, which is all that the xml parser needs.
+    Files made of several compressed streams one after the other (``cat
+    a.gz b.gz``, pbzip2) are read all the way through.
+    """
+    def __init__(self, fh, new_decompressor, head=''):
+        self.fh = fh
+        self.new_decompressor = new_decompressor
+        self.decompressor = new_decompressor()
+        self.pending = head # compressed data that was read already
+        self.buffer = ''
+        self.offset = 0
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or
+                                len(self.buffer) - self.offset < size):
+            self._fill()
+        if size < 0:
+            size = len(self.buffer) - self.offset
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        self.fh.close()
+
+    def _fill(self):
+        data = self.pending or self.fh.read(READ_SIZE)
+        self.pending = ''
+        if not data:
+            self.eof = True
+            return
+        try:
+            out = self.decompressor.decompress(data)
+        except EOFError:
+            # bz2 complains about data after the end of its stream
+            self.decompressor = self.new_decompressor()
+            out = self.decompressor.decompress(data)
+        if getattr(self.decompressor, 'unused_data', ''):
+            # another stream starts right after this one
+            self.pending = self.decompressor.unused_data
+            self.decompressor = self.new_decompressor()
+        # only ever copy what hasn't been read yet
+        self.buffer = self.buffer[self.offset:] + out
+        self.offset = 0
+
+class _Identity(object):
+    """A decompressor for data that isn't compressed"""
+    unused_data = ''
+    def decompress(self, data):
+        return data
+
+def _open_source(source):
+    """Open ``source`` for reading, decompressing it if it's compressed
+
+    ``source`` is a filename, ``-`` for stdin or a file that's already open.
+    gzip, bzip2, xz and zstd are recognized by their magic bytes so the file
+    name doesn't matter. Returns ``(file, close)`` where ``close`` says
+    whether the caller should close the file when it's done with it.
+    """
+    if source == '-':
+        fh, close = sys.stdin, False
+    elif hasattr(source, 'read'):
+        fh, close = source, False
+    else:
+        fh, close = open(source, 'rb'), True
+
+    head = fh.read(6)
+    for magic, new_decompressor in COMPRESSIONS:
+        if head.startswith(magic):
+            return _DecompressingReader(fh, new_decompressor, head), close
+    try:
+        fh.seek(-len(head), os.SEEK_CUR)
+        return fh, close
+    except (IOError, AttributeError):
+        # pipes can't seek
+        return _DecompressingReader(fh, _Identity, head), close
+
+def _iter_elements(source, wanted, parents=False):
+    """Stream the elements of an xml file that ``wanted`` asks for
+
+    ``wanted`` is called with the tuple of tags from the root element down to
+    each element as its end tag is parsed. If it returns true the (complete)
+    element is yielded, and once the caller asks for the next one it is
+    cleared and detached from its parent so that the tree never grows past
+    the element that is currently being looked at. With ``parents`` the
+    (still incomplete) parent element comes along with it, as
+    ``(element, parent)``.
+
+    ``source`` can be anything that ``_open_source`` understands.
+    """
+    fh, close = _open_source(source)
+    path = []
+    open_elements = []
+    try:
+        for event, el in ET.iterparse(fh, events=('start', 'end')):
+            if event == 'start':
+                path.append(el.tag)
+                open_elements.append(el)
+                continue
+
+            if wanted(tuple(path)):
+                parent = open_elements[-2] if len(open_elements) > 1 else None
+                yield (el, parent) if parents else el
+                el.clear()
+                if parent is not None:
+                    # el was the last thing parsed, so it's the last child
+                    del parent[-1]
+            path.pop()
+            open_elements.pop()
+    finally:
+        if close:
+            fh.close()
+
+def _source_list(source):
+    """Importers take a source or a list of them, this makes it a list"""
+    if isinstance(source, (list, tuple)):
+        return list(source)
+    return [source]
+
+def _is_plain_file(source):
+    """Whether ``source`` is the name of an uncompressed file"""
+    if not isinstance(source, basestring) or source == '-':
+        return False
+    if not os.path.getsize(source):
+        # can't be mapped
+        return False
+    with open(source, 'rb') as fh:
+        head = fh.read(6)
+    return not any(head.startswith(magic) for magic, _ in COMPRESSIONS)
+
+# WXR files get cut up into pieces of about this many bytes by --parse-jobs
+SHARD_SIZE = 4 * 1024 * 1024
+
+# everything that matters when looking for items without parsing the xml
+WXR_TOKENS = re.compile(r'<!\[CDATA\[|<!--|<item[\s>]|</item\s*>')
+
+def _wxr_header(data):
+    """The start of a WXR file, up to and including ``<channel>``
+
+    That's the xml declaration and the ``<rss>`` element with all of the
+    namespace declarations, which every shard of the file needs.
+    """
+    match = re.compile(r'<channel[\s>]').search(data)
+    return data[:data.find('>', match.start()) + 1]
+
+def _wxr_shards(data, shard_size=SHARD_SIZE):
+    """Cut the items of a WXR file up into ``(start, end)`` byte ranges
+
+    ``data`` is the whole file, usually an mmap. Every range starts at an
+    ``<item>`` and ends after an ``</item>`` and is at least ``shard_size``
+    bytes long (except for the last one). CDATA sections and comments are
+    skipped over, since WordPress content can contain anything, including
+    ``<item>``.
+    """
+    start = end = None
+    pos = 0
+    search = WXR_TOKENS.search
+    while True:
+        match = search(data, pos)
+        if match is None:
+            break
+        token = match.group()
+        if token == '<![CDATA[':
+            pos = data.find(']]>', match.end()) + 3
+        elif token == '<!--':
+            pos = data.find('-->', match.end()) + 3
+        elif token.startswith('</'):
+            end = pos = match.end()
+            if start is not None and end - start >= shard_size:
+                yield start, end
+                start = None
+        else:
+            if start is None:
+                start = match.start()
+            pos = match.end()
+        if pos < 3:
+            # unterminated CDATA or comment, let the parser complain
+            break
+    if start is not None and end > start:
+        yield start, end
+
+def _iter_wxr_items(source):
+    """Yield every ``<item>`` of a WXR file as it was written, from its start
+    tag to its end tag, without parsing anything
+
+    The same tokens as ``_wxr_shards``, but the file is read a chunk at a
+    time so that it works with anything ``_open_source`` can open.
+    """
+    fh, close = _open_source(source)
+    search = WXR_TOKENS.search
+    data = ''
+    pos = 0 # where to look for the next token
+    start = None # where the current item started
+    try:
+        while True:
+            chunk = fh.read(16 * READ_SIZE)
+            keep = pos if start is None else start
+            data = data[keep:] + chunk
+            pos -= keep
+            if start is not None:
+                start = 0
+            while True:
+                match = search(data, pos)
+                if match is None:
+                    # the end of the chunk could have cut a token in half
+                    pos = max(pos, len(data) - 16)
+                    break
+                token = match.group()
+                if token == '<![CDATA[' or token == '<!--':
+                    end = data.find(']]>' if token == '<![CDATA[' else '-->',
+                                    match.end())
+                    if end == -1:
+                        # wait for the rest of it
+                        pos = match.start()
+                        break
+                    pos = end + 3
+                elif token.startswith('</'):
+                    pos = match.end()
+                    if start is not None:
+                        yield data[start:pos]
+                        start = None
+                else:
+                    start = match.start()
+                    pos = match.end()
+            if not chunk:
+                break
+    finally:
+        if close:
+            fh.close()
+
+# the elements of an item that --plan looks at
+WXR_PLAN_TAGS = ('title', 'content:encoded', 'wp:post_id', 'wp:status',
+                 'wp:post_type')
+WXR_PLAN_TOKENS = re.compile(r'<!\[CDATA\[|<!--|<(%s)>' % '|'.join(
+    re.escape(tag) for tag in WXR_PLAN_TAGS))
+
+XML_ENTITIES = (('&lt;', '<'), ('&gt;', '>'), ('&quot;', '"'),
+                ('&apos;', "'"), ('&amp;', '&'))
+
+def _wxr_text(raw):
+    """The text of an element, from what's between its tags: either CDATA
+    (which WordPress splits up around any ``]]>`` in the content) or
+    escaped xml"""
+    if raw.startswith('<![CDATA[') and raw.endswith(']]>'):
+        return raw[9:-3].replace(']]><![CDATA[', '')
+    if '&' not in raw:
+        return raw
+    for entity, char in XML_ENTITIES:
+        raw = raw.replace(entity, char)
+    return raw
+
+def _wxr_plan_fields(item):
+    """``{tag: text}`` for the ``WXR_PLAN_TAGS`` of an item from
+    ``_iter_wxr_items``
+
+    The first of each one wins, which is the item's own: comments come after
+    all of them, and CDATA sections get skipped over so whatever is in the
+    content doesn't count.
+    """
+    fields = {}
+    pos = 0
+    search = WXR_PLAN_TOKENS.search
+    while len(fields) < len(WXR_PLAN_TAGS):
+        match = search(item, pos)
+        if match is None:
+            break
+        tag = match.group(1)
+        if tag is None:
+            end = item.find(']]>' if match.group() == '<![CDATA[' else '-->',
+                            match.end())
+            if end == -1:
+                break
+            pos = end + 3
+            continue
+        # the end tag is the first one after its CDATA sections, if it
+        # has any
+        close = '</%s>' % tag
+        start = end = match.end()
+        while item.startswith('<![CDATA[', end):
+            end = item.find(']]>', end + 9) + 3
+            if end < 3:
+                end = len(item)
+        end_tag = item.find(close, end)
+        if end_tag == -1:
+            end_tag = len(item)
+        fields.setdefault(tag, _wxr_text(item[start:end_tag]))
+        pos = end_tag + len(close)
+    return fields
+
+# the tables that get_posts_from_pma_xml needs to read
+WP_TABLES = frozenset(['wp_posts', 'wp_terms', 'wp_term_taxonomy',
+                       'wp_term_relationships', 'wp_users'])
+
+def _revision_key(post):
+    """Sort key for revisions of the same post, oldest first"""
+    id = post[u'id']
+    return post[u'date'], int(id) if id.isdigit() else id
+
+# the fields of an exported comment -> the wp_comments column that they come
+# from
+COMMENT_COLUMNS = {
+    'id': 'comment_ID',
+    'parent': 'comment_parent',
+    'date': 'comment_date',
+    'author': 'comment_author',
+    'author_email': 'comment_author_email',
+    'author_url': 'comment_author_url',
+    'type': 'comment_type',
+    'content': 'comment_content',
+    'approved': 'comment_approved',
+    }
+# WXR files use the same names, in lower case
+WXR_COMMENT_COLUMNS = dict((field, wp(column.lower()))
+                           for field, column in COMMENT_COLUMNS.iteritems())
+
+def _comment(values, columns=COMMENT_COLUMNS):
+    """Build a comment out of a row, or None if it isn't approved
+
+    ``values`` is ``{column: value}``, for WXR that's ``{tag: text}`` of
+    the ``<wp:comment>``'s children with ``WXR_COMMENT_COLUMNS``. Pending
+    comments, spam and the trash stay in WordPress.
+    """
+    if values.get(columns['approved']) != '1':
+        return None
+    return dict((field, values.get(column) or u'')
+                for field, column in columns.iteritems()
+                if field != 'approved')
+
+def _iter_pma_rows(source, tables):
+    """Yield ``(table_name, {column: value})`` for every row of ``tables`` in
+    a PHPMyAdmin xml dump"""
+    for el in _iter_elements(source, lambda path: path[-1] == 'table'):
+        table = el.get('name')
+        if table in tables:
+            yield table, dict((col.get('name'), col.text) for col in el)
+
+# how much of a mysqldump file has to have been read ahead to make sense of
+# the next bit of it (a statement's start, a column list...)
+SQL_LOOKAHEAD = 16 * 1024
+
+# mysqldump files are tokenized with these, see _SqlScanner
+SQL_SKIP = re.compile(r'(?:\s+|;|--[^\n]*(?:\n|$)|#[^\n]*(?:\n|$)|/\*.*?\*/)*',
+                      re.S)
+SQL_STATEMENT = re.compile(r'(CREATE\s+TABLE(?:\s+IF\s+NOT\s+EXISTS)?|'
+                           r'(?:INSERT|REPLACE)(?:\s+IGNORE)?\s+INTO)\s+'
+                           r'`?([^`\s(]+)`?\s*', re.I)
+# anything that has to be skipped over as a whole in a statement
+SQL_STRING = (r"'[^'\\]*(?:(?:\\.|'')[^'\\]*)*'|"
+              r'"[^"\\]*(?:(?:\\.|"")[^"\\]*)*"')
+SQL_TOKEN = re.compile(SQL_STRING + r'|`[^`]*`|[;(),]|[\'"`]', re.S)
+# what SQL_TOKEN finds when a string doesn't end
+SQL_QUOTES = frozenset('\'"`')
+# everything up to the end of a statement, or to a string that doesn't end
+SQL_STATEMENT_BODY = re.compile(
+    r"""[^;'"`]*(?:(?:%s|`[^`]*`)[^;'"`]*)*"""
+    % SQL_STRING, re.S)
+SQL_COLUMN = re.compile(r'\s*`([^`]+)`')
+SQL_COLUMN_LIST = re.compile(r'\(([^)]*)\)\s*')
+SQL_VALUES = re.compile(r'VALUES\s*', re.I)
+SQL_TUPLE = re.compile(r'\s*\(')
+SQL_VALUE = re.compile(r"\s*(?:(?:_\w+\s*)?(" + SQL_STRING +
+                       r")|(NULL)|([-+.\w]+))\s*([,)])", re.S | re.I)
+SQL_NEXT_TUPLE = re.compile(r'\s*([,;]|$)')
+# the quote a string is in -> what needs unescaping in it
+SQL_ESCAPE = {"'": re.compile(r"\\(.)|''", re.S),
+              '"': re.compile(r'\\(.)|""', re.S)}
+SQL_ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t',
+               'Z': '\x1a'}
+
+def _sql_unescape(match):
+    char = match.group(1)
+    if char is None:
+        # a doubled quote
+        return match.group()[0]
+    if char in '%_':
+        # mysql keeps the backslash for these two
+        return '\\' + char
+    return SQL_ESCAPES.get(char, char)
+
+# the escapes that mysqldump writes, and what they stand for
+SQL_ESCAPE_PAIRS = [('\\' + char, SQL_ESCAPES.get(char, char))
+                    for char in '0bnrtZ\'"']
+
+def _sql_string(quote, string):
+    """Unescape the inside of a string that was in ``quote``s
+
+    A post's content is full of escaped quotes and newlines, and replacing
+    them one kind at a time is a lot quicker than a regex with a callback
+    for each of them. Escaped backslashes are split out first so that
+    they can't be mistaken for the start of another escape. Anything else
+    (doubled quotes, ``\\%``...) goes through ``SQL_ESCAPE``.
+    """
+    if quote * 2 in string:
+        return SQL_ESCAPE[quote].sub(_sql_unescape, string)
+    pieces = string.split('\\\\')
+    for i, piece in enumerate(pieces):
+        if '\\' not in piece:
+            continue
+        unescaped = piece
+        for escape, char in SQL_ESCAPE_PAIRS:
+            unescaped = unescaped.replace(escape, char)
+        if '\\' in unescaped:
+            unescaped = SQL_ESCAPE[quote].sub(_sql_unescape, piece)
+        pieces[i] = unescaped
+    return '\\'.join(pieces)
+
+class _SqlScanner(object):
+    """Matches regexes against a file that's read a chunk at a time
+
+    There's always at least ``SQL_LOOKAHEAD`` of the file ahead to match
+    against (which is plenty for anything but a value), and a match that
+    runs into the end of that is tried again with more. Whatever has been
+    matched gets thrown away as the next chunk comes in, so the scanner
+    holds on to about a chunk, or one value if that's bigger (a huge
+    post's content, say).
+    """
+    def __init__(self, fh):
+        self.fh = fh
+        self.buf = ''
+        self.pos = 0
+        self.offset = 0 # of buf in the file
+        self.eof = False
+
+    def _fill(self):
+        # read as much as is already buffered, so that a value that keeps
+        # on going doesn't get scanned over and over
+        chunk = self.fh.read(max(READ_SIZE, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+        self.offset += self.pos
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def match(self, regex, unbounded=False):
+        """Match ``regex`` where the last match left off, and move past it
+
+        If an ``unbounded`` regex doesn't match, that might be because its
+        match goes on past what has been read, so it's tried again with more
+        (until the file runs out).
+        """
+        while len(self.buf) - self.pos < SQL_LOOKAHEAD and not self.eof:
+            self._fill()
+        while True:
+            match = regex.match(self.buf, self.pos)
+            if self.eof:
+                break
+            if match is None:
+                if not unbounded:
+                    break
+            elif match.end() < len(self.buf):
+                break
+            self._fill()
+        if match is not None:
+            self.pos = match.end()
+        return match
+
+    def expect(self, regex, what, unbounded=False):
+        match = self.match(regex, unbounded)
+        if match is None:
+            raise ValueError("expected %s at byte %d of the sql dump, found "
+                             "%r" % (what, self.offset + self.pos,
+                                     self.buf[self.pos:self.pos + 40]))
+        return match
+
+    def skip_to(self, tokens):
+        """Search for the next ``SQL_TOKEN`` that's in ``tokens``, stepping
+        over strings and everything else, and move past it"""
+        while True:
+            match = SQL_TOKEN.search(self.buf, self.pos)
+            if (match is None or match.end() == len(self.buf) or
+                    match.group() in SQL_QUOTES):
+                # nothing, or a string that doesn't end in what's been read
+                if self.eof:
+                    self.pos = len(self.buf)
+                    return None
+                self._fill()
+                continue
+            self.pos = match.end()
+            if match.group() in tokens:
+                return match.group()
+
+    def skip_statement(self):
+        """Move past the end of the current statement
+
+        Like ``skip_to(';')``, but a lot quicker, since it steps over
+        everything that's been read in one go.
+        """
+        while True:
+            self.pos = SQL_STATEMENT_BODY.match(self.buf, self.pos).end()
+            if self.buf.startswith(';', self.pos):
+                self.pos += 1
+                return
+            # the end of what's been read, or a string that goes past it
+            if self.eof:
+                self.pos = len(self.buf)
+                return
+            self._fill()
+
+    def at_end(self):
+        self.match(SQL_SKIP)
+        return self.eof and self.pos == len(self.buf)
+
+def _iter_sql_rows(source, tables):
+    """Yield ``(table_name, {column: value})`` for every row of ``tables`` in
+    a mysqldump file
+
+    The columns of a table come from its ``CREATE TABLE``, or the column
+    list of an ``INSERT``. Values come out just like the ones from
+    ``_iter_pma_rows``: strings as text, numbers as they were written and
+    empty strings as None. Statements that aren't about
+    ``tables`` are skipped without looking at their values.
+    """
+    fh, close = _open_source(source)
+    scanner = _SqlScanner(fh)
+    columns = {}
+    try:
+        while not scanner.at_end():
+            statement = scanner.match(SQL_STATEMENT)
+            if statement is None:
+                # SET, LOCK TABLES, DROP TABLE...
+                scanner.skip_statement()
+                continue
+            table = statement.group(2)
+            if table not in tables:
+                scanner.skip_statement()
+            elif statement.group(1)[0] in 'cC':
+                columns[table] = _sql_create_table(scanner)
+            else:
+                for row in _sql_insert(scanner, table, columns.get(table)):
+                    yield table, row
+    finally:
+        if close:
+            fh.close()
+
+def _sql_create_table(scanner):
+    """Read the column names out of a ``CREATE TABLE``"""
+    scanner.expect(SQL_TUPLE, "'('")
+    names = []
+    while True:
+        column = scanner.match(SQL_COLUMN)
+        if column is not None:
+            names.append(column.group(1))
+        # the rest of the definition (or a KEY, or a CONSTRAINT...)
+        depth = 0
+        while True:
+            token = scanner.skip_to('(),')
+            if token == '(':
+                depth += 1
+            elif token == ')' and depth:
+                depth -= 1
+            elif token is None or depth == 0:
+                break
+        if token != ',':
+            break
+    scanner.skip_statement()
+    return names
+
+def _sql_insert(scanner, table, names):
+    """Yield the rows of a (multi-row) ``INSERT`` as dicts"""
+    column_list = scanner.match(SQL_COLUMN_LIST)
+    if column_list is not None:
+        names = [name.strip().strip('`')
+                 for name in column_list.group(1).split(',')]
+    if names is None:
+        raise ValueError("don't know the columns of %s, the dump needs its "
+                         "CREATE TABLE" % table)
+    scanner.expect(SQL_VALUES, 'VALUES')
+    while True:
+        scanner.expect(SQL_TUPLE, "'('")
+        values = []
+        while True:
+            # a value ends in a ',' or ')', so if one matches in what has
+            # been read already it's all there
+            value = SQL_VALUE.match(scanner.buf, scanner.pos)
+            if value is not None:
+                scanner.pos = value.end()
+            else:
+                value = scanner.expect(SQL_VALUE, 'a value', unbounded=True)
+            string, null, bare, end = value.groups()
+            if string is not None:
+                quote, string = string[0], string[1:-1]
+                if '\\' in string or quote in string:
+                    string = _sql_string(quote, string)
+                # just like ElementTree, ascii stays a str (mynt's tag lists
+                # show the difference) and empty is None
+                try:
+                    string.decode('ascii')
+                except UnicodeDecodeError:
+                    string = string.decode('utf-8')
+                values.append(string or None)
+            elif null is not None:
+                values.append(None)
+            else:
+                values.append(bare)
+            if end == ')':
+                break
+        yield dict(zip(names, values))
+        if scanner.expect(SQL_NEXT_TUPLE, "',' or ';'").group(1) != ',':
+            return
+
+# runs of blank lines that the converter collapses
+COLLAPSE_NEWLINES = re.compile('\n{3,}')
+# the tags that HtmlPreProcessor.convert can find without HTMLParser, end
+# tags are bare and attributes are lowercase and double-quoted
+SIMPLE_TAGS = ('p', 'em', 'i', 'strong', 'b', 'code', 'a')
+SIMPLE_MARKUP = re.compile(r'</(%(tags)s)>|<(%(tags)s)((?: %(attr)s)*)>' % {
+    'tags': '|'.join(SIMPLE_TAGS),
+    'attr': r'[a-z][-a-z0-9_:]*="[^"<>\n]*"'})
+SIMPLE_ATTR = re.compile(r' ([a-z][-a-z0-9_:]*)="([^"]*)"')
 
 class HtmlPreProcessor(HTMLParser):
-    """Replaces <pre> tags with markdown code blocks
+    """Replaces <pre> tags with markdown code blocks, among other things
 
     Pass in the html with `feed`, and read out the markdownified junk with
     `readmd()`.
@@ -45,48 +846,225 @@ class HtmlPreProcessor(HTMLParser):
 
     This class takes advantage of the fact that HTML is actually valid
     markdown, and does't do much processing, letting `handle_data` just store
-    more or less everything that we get.
+    more or less everything that we get. The exception is lists and
+    blockquotes: it keeps a stack of the ones that it's inside of, so that
+    they can be converted (nested and all) by prefixing every line with the
+    right amount of indentation and ``>``.
+
+    The output is kept as a list of chunks, and newlines always get a chunk
+    of their own. Anything that needs to look back at what has already been
+    written (whitespace around end tags, collapsing runs of blank lines)
+    only ever looks at the last couple of chunks, so converting a post takes
+    time linear in its size no matter how many tags it has.
     """
     def __init__(self, markdown_interpreter='misaka'):
         HTMLParser.__init__(self)
-        self.buffer = ""
-        self.in_pre = False
-        self.end_whitespace = re.compile(r'[ \t\n]\Z')
         self.md_interpreter = markdown_interpreter
 
     def reset(self):
         HTMLParser.reset(self)
-        self.buffer = ""
+        self.chunks = []
         self.in_pre = False
+        # the lists, list items and blockquotes that we're inside of, as
+        # [tag, line prefix, next list number]
+        self.stack = []
+        self.prefix = ''
+        # how many newlines the output ends with, blank quoted lines count
+        self.newlines = 0
+        self.line_start = True
+        # right after a list marker, where whitespace isn't interesting
+        self.item_start = False
+        # how many newlines have to come before anything else, because a
+        # list item or block just ended
+        self.pending_newlines = 0
 
     def readmd(self):
-        return re.sub(r'\n\n\n+', '\n\n', self.buffer)
+        return ''.join(self.chunks)
+
+    def convert(self, html, fast=True):
+        """Convert all of ``html`` at once, returning the markdown and how
+
+        Most posts are plain text with a couple of links and some emphasis,
+        and those don't need all of HTMLParser. Without any markup at all
+        the only thing to do is collapsing runs of blank lines ('text'). If
+        the only markup is ``SIMPLE_TAGS`` (and there are no entities),
+        they're picked out with a single regex and handed to the usual
+        handlers ('simple'). Everything else gets fed to HTMLParser
+        ('html'). The markdown comes out the same whichever way it went,
+        ``fast=False`` always takes the long way.
+        """
+        self.reset()
+        if fast and '&' not in html:
+            if '<' not in html:
+                if '\n\n\n' in html:
+                    html = COLLAPSE_NEWLINES.sub('\n\n', html)
+                return html, 'text'
+            tags = self._simple_markup(html)
+            if tags is not None:
+                pos = 0
+                for match in tags:
+                    if match.start() > pos:
+                        self.handle_data(html[pos:match.start()])
+                    end_tag, start_tag, attrs = match.groups()
+                    if end_tag:
+                        self.handle_endtag(end_tag)
+                    else:
+                        self.handle_starttag(start_tag,
+                                             SIMPLE_ATTR.findall(attrs))
+                    pos = match.end()
+                if pos < len(html):
+                    self.handle_data(html[pos:])
+                return self.readmd(), 'simple'
+
+        self.feed(html)
+        return self.readmd(), 'html'
+
+    @staticmethod
+    def _simple_markup(html):
+        """Find all of the tags in ``html``, if they're all simple ones"""
+        tags = []
+        match = SIMPLE_MARKUP.match
+        find = html.find
+        pos = find('<')
+        while pos >= 0:
+            tag = match(html, pos)
+            if tag is None:
+                return None
+            tags.append(tag)
+            pos = find('<', tag.end())
+        return tags
 
     def handle_data(self, data):
-        """Put all of the processed data into a buffer
+        """Put all of the processed data into the output
 
         While this class doesn't actually do much processing, this is where
-        the result of it goes.
+        the result of it goes. More than two newlines in a row get collapsed
+        to two as they come in.
         """
-        self.buffer += data
+        if self.item_start and not data.strip():
+            return
+        lines = data.split('\n')
+        self._write(lines[0])
+        for line in lines[1:]:
+            self._newline()
+            self._write(line)
+
+    def _write(self, text):
+        """Append a bit of text that doesn't have any newlines in it"""
+        if self.pending_newlines and text.strip(' \t'):
+            while self.newlines < self.pending_newlines:
+                self._newline()
+            self.pending_newlines = 0
+        if self.stack and not self.in_pre and (self.line_start or
+                                               self.item_start):
+            # indentation is ours to decide inside of lists and quotes
+            text = text.lstrip(' \t')
+        if not text:
+            return
+        if self.line_start and self.prefix:
+            self.chunks.append(self.prefix)
+        self.chunks.append(text)
+        self.newlines = 0
+        self.line_start = self.item_start = False
+
+    def _newline(self):
+        if self.newlines >= 2:
+            return
+        if self.line_start and self.prefix.strip():
+            # keep blank lines inside of the blockquote
+            self.chunks.append(self.prefix.rstrip())
+        self.chunks.append('\n')
+        self.newlines += 1
+        self.line_start = True
+        self.item_start = False
+
+    def _block_break(self):
+        """Make sure that what comes next starts a new paragraph"""
+        if self.chunks:
+            self._newline()
+            self._newline()
+
+    def _last_char(self):
+        return self.chunks[-1][-1] if self.chunks else ''
+
+    def _endswith(self, end):
+        tail = ''
+        for chunk in reversed(self.chunks):
+            tail = chunk + tail
+            if len(tail) >= len(end):
+                break
+        return tail.endswith(end)
+
+    def _rstrip(self, chars=None):
+        """``rstrip`` the output, looking at as few chunks as possible"""
+        while self.chunks:
+            chunk = self.chunks[-1].rstrip(chars)
+            if chunk:
+                self.chunks[-1] = chunk
+                break
+            self.chunks.pop()
+
+        # figure out where that left us
+        blank_prefix = self.prefix.rstrip()
+        self.newlines = 0
+        for chunk in reversed(self.chunks):
+            if chunk == '\n':
+                self.newlines += 1
+            elif chunk != blank_prefix:
+                break
+        self.line_start = not self.chunks or self.newlines > 0
+        self.item_start = False
 
     def append_endtag(self, end):
-        """Append a markdown end tag to the buffer.
+        """Append a markdown end tag to the output.
 
         Markdown is much more sensitive to whitespace than html is, so we
         have to be careful.
         """
-        end_white = self.end_whitespace.search(self.buffer)
-        self.buffer = self.buffer.rstrip()
+        end_white = self._last_char()
+        self._rstrip()
 
         # only append the end tag if there is something inside of it
-        if self.buffer.endswith(end):
-            self.buffer = self.buffer.rstrip(end)
+        if self._endswith(end):
+            self._rstrip(end)
         else:
-            self.buffer += end
+            self._write(end)
+
+        if end_white in (' ', '\t', '\n'):
+            self.handle_data(end_white)
+
+    def _close(self, tag):
+        """Close a list item, list or blockquote, if it's actually open"""
+        if not self._pop(tag):
+            return
+
+        # blank lines at the end of a block would still have its prefix
+        while self.chunks and not self.chunks[-1].strip(' \t\n>'):
+            self.chunks.pop()
+        self.newlines = 0
+        self.line_start = not self.chunks
+        self.item_start = False
+
+        # the next item in the same list only needs a new line, everything
+        # else needs a new paragraph
+        self.pending_newlines = 1 if tag == 'li' else 2
+
+    def _push(self, tag, prefix, number=1):
+        self.stack.append([tag, prefix, number])
+        self.prefix += prefix
 
-        if end_white:
-            self.buffer += end_white.group(0)
+    def _pop(self, tag):
+        """Close the innermost open ``tag``, and everything inside of it
+
+        Returns False if there is no ``tag`` to close: WordPress doesn't
+        exactly guarantee balanced tags.
+        """
+        tags = [entry[0] for entry in self.stack]
+        if tag not in tags:
+            return False
+        del self.stack[len(tags) - 1 - tags[::-1].index(tag):]
+        self.prefix = ''.join(entry[1] for entry in self.stack)
+        return True
 
     def handle_entityref(self, name):
         entity = "&%s;" % name
@@ -131,6 +1109,35 @@ class HtmlPreProcessor(HTMLParser):
             self.handle_data('_')
         elif tag in ('strong', 'b'):
             self.handle_data('**')
+        elif tag in ('ul', 'ol'):
+            if self.stack and self.stack[-1][0] == 'li':
+                # a nested list, it just needs a line of its own
+                self.item_start = False
+                if not self.line_start:
+                    self._newline()
+            else:
+                self._block_break()
+            number = 1
+            for name, val in attrs:
+                if name == 'start' and val.isdigit():
+                    number = int(val)
+            self._push(tag, '', number)
+        elif tag == 'li':
+            if self.stack and self.stack[-1][0] == 'li':
+                # the </li> is optional
+                self._pop('li')
+            if not self.line_start:
+                self._newline()
+            if self.stack and self.stack[-1][0] == 'ol':
+                self._write('%d. ' % self.stack[-1][2])
+                self.stack[-1][2] += 1
+            else:
+                self._write('- ')
+            self._push('li', '    ')
+            self.item_start = True
+        elif tag == 'blockquote':
+            self._block_break()
+            self._push('blockquote', '> ')
         else:
             # pass the data through
             atts = ' '.join('%s="%s"' % (a, v) for a, v in attrs)
@@ -139,25 +1146,1357 @@ class HtmlPreProcessor(HTMLParser):
             else:
                 self.handle_data("<%s>" % tag)
 
-    def handle_endtag(self, tag):
-        if tag == 'pre':
-            self.in_pre = False
-            self.handle_data("\n~~~\n")
-        elif tag == 'code':
-            self.handle_data('`')
-        elif tag == 'a':
-            if self.link['title']:
-                self.handle_data('](%(href)s "%(title)s") ' % self.link)
-            else:
-                self.handle_data('](%s) ' % self.link['href'])
-        elif tag == 'p':
-            self.handle_data('\n')
-        elif tag in ('em', 'i'):
-            self.append_endtag('_')
-        elif tag in ('strong', 'b'):
-            self.append_endtag('**')
-        else:
-            self.handle_data("</%s>" % tag)
+    def handle_endtag(self, tag):
+        if tag == 'pre':
+            self.in_pre = False
+            self.handle_data("\n~~~\n")
+        elif tag == 'code':
+            self.handle_data('`')
+        elif tag == 'a':
+            if self.link['title']:
+                self.handle_data('](%(href)s "%(title)s") ' % self.link)
+            else:
+                self.handle_data('](%s) ' % self.link['href'])
+        elif tag == 'p':
+            self.handle_data('\n')
+        elif tag in ('em', 'i'):
+            self.append_endtag('_')
+        elif tag in ('strong', 'b'):
+            self.append_endtag('**')
+        elif tag in ('li', 'ul', 'ol', 'blockquote'):
+            self._close(tag)
+        else:
+            self.handle_data("</%s>" % tag)
+
+def _thread_cpu_clock():
+    """A function that returns how much cpu time the thread that calls it
+    has used, or None where there's no way to tell
+
+    That's clock_gettime(CLOCK_THREAD_CPUTIME_ID) through ctypes, since
+    python 2 has no clock_gettime. getrusage(RUSAGE_THREAD) would do too,
+    but it only counts in ticks, and short stages come out as nonsense.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (ImportError, OSError, AttributeError):
+        return None
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    CLOCK_THREAD_CPUTIME_ID = 3
+    def thread_cpu():
+        spec = timespec()
+        clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(spec))
+        return spec.tv_sec + spec.tv_nsec / 1e9
+    if clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(timespec())):
+        return None
+    return thread_cpu
+
+# None where Stats has to make do with the whole process's cpu time
+THREAD_CPU = _thread_cpu_clock()
+
+class Stats(object):
+    """Keeps track of where the time of a run goes, stage by stage
+
+    Every stage gets wall and cpu time, a count of the things that went
+    through it and how many bytes they were. Time is charged exclusively:
+    while a stage is running inside of another one (an exporter pulling
+    posts out of the parser, say) the outer stage's clock is stopped.
+
+    Stages can run in different threads at once (every thread needs a
+    Stats of its own), so cpu time is that of the thread that the stage ran
+    in, where there's a way to tell (``per_thread``). Otherwise it's the
+    whole process's, and stages that overlap are charged for each other.
+
+    ``counters`` are for everything else that's worth reporting, like posts
+    that were skipped.
+    """
+    def __init__(self, stages=()):
+        # stages are reported in the order they were first used, unless
+        # they are listed up front
+        self.stages = OrderedDict()
+        for name in stages:
+            self._stage(name)
+        self.counters = OrderedDict()
+        self.started = time.time()
+        self.started_cpu = self._process_cpu()
+        self._stack = []
+        self._mark = None
+
+    per_thread = THREAD_CPU is not None
+
+    @staticmethod
+    def _process_cpu():
+        times = os.times()
+        return times[0] + times[1]
+
+    @classmethod
+    def _now(cls):
+        if not cls.per_thread:
+            return time.time(), cls._process_cpu()
+        return time.time(), THREAD_CPU()
+
+    def _stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'wall': 0.0, 'cpu': 0.0,
+                                 'items': 0, 'bytes': 0}
+        return self.stages[name]
+
+    def _charge(self):
+        now = self._now()
+        if self._stack:
+            stage = self._stage(self._stack[-1])
+            stage['wall'] += now[0] - self._mark[0]
+            stage['cpu'] += now[1] - self._mark[1]
+        self._mark = now
+
+    def enter(self, name):
+        self._charge()
+        self._stack.append(name)
+
+    def exit(self):
+        self._charge()
+        self._stack.pop()
+
+    def add(self, name, items=1, nbytes=0):
+        stage = self._stage(name)
+        stage['items'] += items
+        stage['bytes'] += nbytes
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def timed(self, name, iterable, size=None):
+        """Charge the time spent getting things out of ``iterable`` to
+        ``name``, and count them (and their ``size``) as its items"""
+        iterator = iter(iterable)
+        while True:
+            self.enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            self.add(name, 1, size(item) if size else 0)
+            yield item
+
+    def drain(self):
+        """Return everything collected so far and start over, for sending
+        the stats of a worker process to its parent"""
+        collected = (self.stages, self.counters)
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        return collected
+
+    def merge(self, collected, suffix=''):
+        stages, counters = collected
+        for name, values in stages.iteritems():
+            stage = self._stage(name + suffix)
+            for key in stage:
+                stage[key] += values[key]
+        for name, n in counters.iteritems():
+            self.count(name, n)
+
+    def report(self):
+        return {'wall': time.time() - self.started,
+                'cpu': self._process_cpu() - self.started_cpu,
+                'cpu_per_thread': self.per_thread,
+                'stages': OrderedDict(
+                    (name, stage) for name, stage in self.stages.iteritems()
+                    if stage['items'] or stage['wall']),
+                'counters': self.counters}
+
+    def summary(self):
+        lines = ['%-24s %9s %9s %9s %9s %10s'
+                 % ('stage', 'wall s', 'cpu s', 'items', 'MB', 'items/s')]
+        for name, stage in self.stages.iteritems():
+            if not stage['items'] and not stage['wall']:
+                continue
+            rate = stage['items'] / stage['wall'] if stage['wall'] else 0
+            lines.append('%-24s %9.3f %9.3f %9d %9.2f %10.1f'
+                         % (name, stage['wall'], stage['cpu'],
+                            stage['items'], stage['bytes'] / 2.0 ** 20,
+                            rate))
+        lines.append('%-24s %9.3f %9.3f'
+                     % ('total', time.time() - self.started,
+                        self._process_cpu() - self.started_cpu))
+        if self.per_thread:
+            lines.append('(cpu is that of the thread that each stage ran '
+                         'in, the total is the whole process)')
+        else:
+            lines.append('(cpu is the whole process, stages that ran at '
+                         'the same time are charged for each other)')
+        for name, n in self.counters.iteritems():
+            lines.append('%s: %d' % (name, n))
+        return '\n'.join(lines) + '\n'
+
+class NullStats(Stats):
+    """Stats that don't bother, for when nobody asked for them"""
+    def enter(self, name):
+        pass
+
+    def exit(self):
+        pass
+
+    def add(self, name, items=1, nbytes=0):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def timed(self, name, iterable, size=None):
+        return iterable
+
+class SourceReport(object):
+    """Keeps track of how much came out of each input file, and how fast
+
+    A file's clock starts when it's opened and stops once the last of its
+    posts (or rows) has been taken out of it, so it includes the time that
+    the rest of the pipeline spends on them, and with ``--parse-jobs``
+    several files can be on the clock at once.
+    """
+    def __init__(self):
+        self.sources = OrderedDict()
+
+    def start(self, source, unit='posts'):
+        size = None
+        if isinstance(source, basestring) and source != '-':
+            size = os.path.getsize(source)
+        self.sources[source] = {'unit': unit, 'items': 0, 'bytes': size,
+                                'start': time.time(), 'end': None}
+
+    def add(self, source, n=1):
+        self.sources[source]['items'] += n
+
+    def finish(self, source):
+        self.sources[source]['end'] = time.time()
+
+    def reading(self, source, items, unit='posts'):
+        """Count the ``items`` that come out of ``source`` as they go past"""
+        self.start(source, unit)
+        entry = self.sources[source]
+        for item in items:
+            entry['items'] += 1
+            yield item
+        self.finish(source)
+
+    @staticmethod
+    def _line(name, unit, items, nbytes, seconds):
+        line = '%s: %d %s' % (name, items, unit)
+        if nbytes is not None:
+            line += ', %.1f MB' % (nbytes / 2.0 ** 20)
+        line += ' in %.2fs' % seconds
+        if seconds:
+            rates = ['%.1f %s/s' % (items / seconds, unit)]
+            if nbytes is not None:
+                rates.append('%.2f MB/s' % (nbytes / 2.0 ** 20 / seconds))
+            line += ' (%s)' % ', '.join(rates)
+        return line
+
+    def summary(self):
+        """A line per file, and one for all of them together"""
+        if not self.sources:
+            return ''
+        now = time.time()
+        lines = []
+        for source, entry in self.sources.iteritems():
+            name = source if isinstance(source, basestring) else \
+                   getattr(source, 'name', repr(source))
+            lines.append(self._line(name, entry['unit'], entry['items'],
+                                    entry['bytes'],
+                                    (entry['end'] or now) - entry['start']))
+        entries = self.sources.values()
+        sizes = [entry['bytes'] for entry in entries
+                 if entry['bytes'] is not None]
+        lines.append(self._line(
+            'total', entries[0]['unit'],
+            sum(entry['items'] for entry in entries),
+            sum(sizes) if sizes else None,
+            max(entry['end'] or now for entry in entries) -
+            min(entry['start'] for entry in entries)))
+        return '\n'.join(lines) + '\n'
+
+# code blocks, and the language that the converter will give them (spelled
+# out instead of re.I, which makes finding them ten times slower)
+PRE_TAG = re.compile(r'<[pP][rR][eE](\s[^>]*)?>')
+PRE_LANG = re.compile(r'(?:^|\s)lang\s*=\s*["\']?([^"\'\s>]*)', re.I)
+
+class Plan(object):
+    """What's in an export, counted by ``--plan`` without converting it
+
+    WXR items only go through a scan that's just good enough to find their
+    id, title, status, type and content (``_wxr_plan_fields``), and dumps
+    only get their ``wp_posts`` rows read, so no posts are built and
+    nothing is converted: it goes about as fast as the file can be read.
+
+    Revisions are counted by type but their content is kept apart, since
+    only pma_xml and sql have them and most of them get dropped.
+    """
+    def __init__(self, input_format='wp_rss', largest=10):
+        self.input_format = input_format
+        self.keep_largest = largest
+        self.items = 0
+        self.statuses = defaultdict(int)
+        self.post_types = defaultdict(int)
+        self.content_bytes = 0
+        self.revision_bytes = 0
+        self.largest = [] # a heap of (size, id, title)
+        self.languages = defaultdict(int)
+        self.unlabeled = 0 # <pre>s without a lang
+        self.source_report = SourceReport()
+
+    def scan(self, source):
+        for each in _source_list(source):
+            getattr(self, 'scan_%s' % self.input_format)(each)
+        return self
+
+    def scan_wp_rss(self, source):
+        items = self.source_report.reading(source, _iter_wxr_items(source),
+                                           'items')
+        for item in items:
+            fields = _wxr_plan_fields(item)
+            self.add(fields.get('wp:post_id'), fields.get('title'),
+                     fields.get('wp:status'), fields.get('wp:post_type'),
+                     fields.get('content:encoded'))
+
+    def _scan_rows(self, source, iter_rows):
+        rows = self.source_report.reading(
+            source, iter_rows(source, frozenset(['wp_posts'])), 'rows')
+        for _, row in rows:
+            content = row['post_content']
+            if isinstance(content, unicode):
+                content = content.encode('utf-8')
+            self.add(row['ID'], row['post_title'], row['post_status'],
+                     row['post_type'], content)
+
+    def scan_pma_xml(self, source):
+        self._scan_rows(source, _iter_pma_rows)
+
+    def scan_sql(self, source):
+        self._scan_rows(source, _iter_sql_rows)
+
+    def add(self, id, title, status, post_type, content):
+        """Count an item, ``content`` is its html as a byte string"""
+        self.items += 1
+        self.statuses[status or u''] += 1
+        self.post_types[post_type or u''] += 1
+        size = len(content) if content else 0
+        if post_type == 'revision':
+            self.revision_bytes += size
+            return
+        self.content_bytes += size
+        entry = (size, id or u'', title or u'')
+        if len(self.largest) < self.keep_largest:
+            heapq.heappush(self.largest, entry)
+        elif entry > self.largest[0]:
+            heapq.heapreplace(self.largest, entry)
+        for match in PRE_TAG.finditer(content or ''):
+            lang = PRE_LANG.search(match.group(1) or '')
+            if lang and lang.group(1):
+                self.languages[lang.group(1).lower()] += 1
+            else:
+                self.unlabeled += 1
+
+    @staticmethod
+    def _text(value):
+        if isinstance(value, str):
+            return value.decode('utf-8', 'replace')
+        return value
+
+    @staticmethod
+    def _by_count(counts):
+        # the keys can be raw bytes out of the source, like <pre lang>s
+        texts = defaultdict(int)
+        for key, n in counts.iteritems():
+            texts[Plan._text(key)] += n
+        return OrderedDict(sorted(texts.iteritems(),
+                                  key=lambda item: (-item[1], item[0])))
+
+    def in_flight(self, jobs):
+        """How many posts (and bytes of content, on average and at worst)
+        can be in flight at once with ``--jobs``: read ahead of the
+        converters (``STAGE_QUEUE_SIZE``) and out with them"""
+        posts = self.items - self.post_types.get('revision', 0)
+        count = min(STAGE_QUEUE_SIZE + jobs * PENDING_PER_JOB, posts)
+        mean = self.content_bytes / posts if posts else 0
+        largest = max(self.largest)[0] if self.largest else 0
+        return count, count * mean, count * largest
+
+    def report(self, jobs=1):
+        count, mean, worst = self.in_flight(jobs)
+        return OrderedDict([
+            ('input_format', self.input_format),
+            ('items', self.items),
+            ('post_types', self._by_count(self.post_types)),
+            ('statuses', self._by_count(self.statuses)),
+            ('content_bytes', self.content_bytes),
+            ('revision_bytes', self.revision_bytes),
+            ('largest', [OrderedDict([('id', self._text(id)),
+                                      ('title', self._text(title)),
+                                      ('bytes', size)])
+                         for size, id, title in sorted(self.largest,
+                                                       reverse=True)]),
+            ('languages', self._by_count(self.languages)),
+            ('unlabeled_pre', self.unlabeled),
+            ('jobs', jobs),
+            ('in_flight', OrderedDict([('posts', count),
+                                       ('mean_bytes', mean),
+                                       ('worst_bytes', worst)])),
+            ])
+
+    def summary(self, jobs=1):
+        report = self.report(jobs)
+        counts = lambda counts: ', '.join(
+            u'%s %d' % (key or u'(none)', n) for key, n in counts.iteritems())
+        kb = lambda size: size / 1024.0
+        posts = self.items - self.post_types.get('revision', 0)
+        lines = [self.source_report.summary().rstrip('\n'),
+                 u'types: %s' % counts(report['post_types']),
+                 u'statuses: %s' % counts(report['statuses']),
+                 u'content: %.1f MB, %.1f KB a post on average'
+                 % (self.content_bytes / 2.0 ** 20,
+                    kb(self.content_bytes / posts if posts else 0))]
+        if self.revision_bytes:
+            lines.append(u'revisions: %.1f MB'
+                         % (self.revision_bytes / 2.0 ** 20))
+        if report['largest']:
+            lines.append(u'largest:')
+            for entry in report['largest']:
+                lines.append(u'  %9.1f KB  %6s  %s'
+                             % (kb(entry['bytes']), entry['id'],
+                                entry['title']))
+        lines.append(u'<pre lang>: %s' % (counts(report['languages'])
+                                          or u'none'))
+        if self.unlabeled:
+            lines.append(u'<pre> without a lang: %d' % self.unlabeled)
+        count, mean, worst = self.in_flight(jobs)
+        lines.append(u'with --jobs %d: up to %d posts read ahead or with '
+                     u'the converters, %.1f MB on average and %.1f MB at '
+                     u'worst (--max-inflight-bytes caps that)'
+                     % (jobs, count, mean / 2.0 ** 20, worst / 2.0 ** 20))
+        if self.input_format != 'wp_rss':
+            lines.append(u'%s holds every post until the whole dump has '
+                         u'been read: %.1f MB of content, plus revisions '
+                         u'with --revisions all (in a temporary file with '
+                         u'--max-inflight-bytes)'
+                         % (self.input_format,
+                            self.content_bytes / 2.0 ** 20))
+        return u'\n'.join(lines) + u'\n'
+
+# the stages of an Exporter run, in order
+STAGES = ('parse', 'manifest', 'parse (waited for)', 'convert',
+          'convert (workers)', 'render', 'write')
+
+def _size(text):
+    """How many bytes ``text`` is, give or take the encoding"""
+    return len(text) if text else 0
+
+# how many posts to keep queued up for each worker process with --jobs
+PENDING_PER_JOB = 4
+
+# how many posts the thread that reads the source can get ahead of the
+# conversions, see Exporter._read_ahead
+STAGE_QUEUE_SIZE = 64
+
+class Cancelled(Exception):
+    """The export that a stage is working for has been called off"""
+
+class StageQueue(object):
+    """The posts on their way from one stage of an export to the next
+
+    Holds up to ``size`` of them. With a ``limit`` on bytes, ``put()`` also
+    waits while the posts that went in and haven't been given back yet
+    (``give_back()``, oldest first, once their files have been handed to
+    the sink) add up to more than that, which is what
+    ``--max-inflight-bytes`` is. But only while there's something in here
+    for the next stage to get on with: a stage that's waiting for posts
+    gets one, whatever the limit, or a converter that reads ahead for its
+    ``--jobs`` would wait forever.
+    """
+    def __init__(self, size=STAGE_QUEUE_SIZE, limit=None):
+        self.size = size
+        self.limit = limit
+        self.items = deque()
+        self.in_flight = 0
+        self.peak = 0
+        # how many times a put() waited for bytes to be given back
+        self.stalls = 0
+        self.sizes = deque()
+        self.cancelled = False
+        self.cond = threading.Condition()
+
+    def _over(self, nbytes):
+        return self.limit and self.in_flight + nbytes > self.limit
+
+    def _full(self, nbytes):
+        if self.cancelled or not self.items:
+            return False
+        return len(self.items) >= self.size or self._over(nbytes)
+
+    def put(self, item, nbytes=0):
+        """Add ``item``, which is ``nbytes`` big, once there's room for it.
+        Returns False if the export is being called off instead."""
+        with self.cond:
+            if self._full(nbytes):
+                if self._over(nbytes):
+                    self.stalls += 1
+                while self._full(nbytes):
+                    self.cond.wait()
+            if self.cancelled:
+                return False
+            self.items.append(item)
+            self.sizes.append(nbytes)
+            self.in_flight += nbytes
+            self.peak = max(self.peak, self.in_flight)
+            self.cond.notify_all()
+            return True
+
+    def get(self):
+        with self.cond:
+            while not self.items:
+                # Condition.wait() can't be interrupted without a timeout
+                self.cond.wait(0xFFFF)
+            item = self.items.popleft()
+            # a reader that's waiting for room might as well wait until
+            # it can put a few in a row
+            if len(self.items) <= self.size // 2:
+                self.cond.notify_all()
+            return item
+
+    def give_back(self):
+        """The oldest post that was put in here is done with"""
+        with self.cond:
+            self.in_flight -= self.sizes.popleft()
+            self.cond.notify_all()
+
+    def cancel(self):
+        """Nobody is getting anything out of here anymore"""
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+
+    def unless_cancelled(self, items):
+        """Yield ``items``, raising ``Cancelled`` as soon as this queue is,
+        for a stage that takes a long time before it puts anything in"""
+        for item in items:
+            if self.cancelled:
+                raise Cancelled()
+            yield item
+
+# set up in each worker process by _init_worker
+_worker = None
+
+def _init_worker(exporter_class, md_interpreter, collect_stats):
+    """Give a worker process its own exporter to do conversions with
+
+    It gets an instance of the exporter class that is doing the export, so
+    that subclasses which override ``_markdownify`` still get called.
+    """
+    global _worker
+    # ctrl-c is the parent's problem, it'll shut us down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker = exporter_class.__new__(exporter_class)
+    _worker.processor = HtmlPreProcessor(md_interpreter)
+    _worker.stats = Stats() if collect_stats else NullStats()
+
+def _markdownify_in_worker(content):
+    """Convert ``content``, returning the markdown and the worker's stats"""
+    _worker.stats.enter('convert')
+    try:
+        markdown = _worker._markdownify(content)
+    finally:
+        _worker.stats.exit()
+    _worker.stats.add('convert', 1, _size(content))
+    return markdown, _worker.stats.drain()
+
+# set up in each worker process by _init_shard_worker
+_shard_worker = None
+
+def _init_shard_worker(exporter_class, post_filter):
+    """Set a worker process up to parse pieces of WXR files"""
+    global _shard_worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _shard_worker = exporter_class.__new__(exporter_class)
+    _shard_worker.post_filter = post_filter
+    _shard_worker.comments = None
+    # the file that the last shard came from: (name, header, map)
+    _shard_worker.wxr_file = (None, None, None)
+
+def _parse_shard_in_worker(filename, start, end):
+    """Parse the items between ``start`` and ``end`` of ``filename``
+
+    Returns the posts, and how many posts the filter rejected since the
+    last shard.
+    """
+    worker = _shard_worker
+    name, header, data = worker.wxr_file
+    if name != filename:
+        # shards mostly come file by file, so one map at a time will do
+        if data is not None:
+            data.close()
+        with open(filename, 'rb') as fh:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        header = _wxr_header(data)
+        worker.wxr_file = filename, header, data
+    shard = StringIO(header + data[start:end] + '</channel></rss>')
+    posts = list(worker._iter_wp_items(shard))
+    rejected = worker.post_filter.rejected
+    worker.post_filter.rejected = OrderedDict()
+    return posts, rejected
+
+############################################################################
+# sinks: where the files that exporters create end up
+
+# archives are written in pieces this big
+ARCHIVE_BUFFER_SIZE = 1024 * 1024
+
+# --fsync choices
+FSYNC_POLICIES = ('none', 'per-file', 'at-end')
+
+def _fsync_path(path):
+    """fsync a file (or directory) that isn't open"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class DirectorySink(object):
+    """Writes every file into a directory, which is the default
+
+    With ``atomic`` every file is written to a temporary name and renamed
+    into place, so nothing ever sees half of a file. ``fsync`` is one of
+    ``FSYNC_POLICIES``: don't bother, sync every file before moving on, or
+    sync all of them (and the directory) once everything has been written.
+    Different files can be written from different threads at once.
+    """
+    uses_stdout = False
+    concurrent = True
+
+    def __init__(self, base_dir, atomic=False, fsync='none'):
+        self.base_dir = base_dir
+        self.atomic = atomic
+        self.fsync = fsync
+        self.written = []
+
+    def write(self, filename, data):
+        self._write(filename, lambda out: out.write(data))
+
+    def write_file(self, filename, fh):
+        """Like ``write``, but the data is copied out of the file ``fh``,
+        which is closed afterwards"""
+        try:
+            self._write(filename, lambda out: shutil.copyfileobj(fh, out))
+        finally:
+            fh.close()
+
+    def _write(self, filename, fill):
+        path = os.path.join(self.base_dir, filename)
+        tmp = path
+        if self.atomic:
+            tmp = os.path.join(self.base_dir, '.%s.wp-md-tmp' % filename)
+        with open(tmp, 'wb') as out:
+            fill(out)
+            if self.fsync == 'per-file':
+                out.flush()
+                os.fsync(out.fileno())
+        if self.atomic:
+            os.rename(tmp, path)
+        if self.fsync == 'at-end':
+            self.written.append(path)
+
+    def close(self):
+        for path in self.written:
+            _fsync_path(path)
+        self.written = []
+        if self.fsync != 'none':
+            # makes the new directory entries (and renames) stick
+            _fsync_path(self.base_dir)
+
+class TarSink(object):
+    """Writes every file into one tar archive
+
+    ``path`` is the archive to create, or ``-`` to stream it to stdout.
+    ``compression`` is '', 'gz' or 'bz2'. The archive is written as a
+    stream, so it never has to seek and nothing is held on to after it's
+    been written. Any ``fsync`` other than 'none' syncs the archive when
+    it's closed.
+    """
+    concurrent = False
+
+    def __init__(self, path, compression='', fsync='none'):
+        self.uses_stdout = path == '-'
+        if self.uses_stdout:
+            self.fh = sys.stdout
+        else:
+            self.fh = open(path, 'wb', ARCHIVE_BUFFER_SIZE)
+        self.tar = tarfile.open(fileobj=self.fh, mode='w|' + compression,
+                                bufsize=ARCHIVE_BUFFER_SIZE)
+        self.mtime = time.time()
+        self.fsync = fsync
+
+    def write(self, filename, data):
+        self._add(filename, len(data), StringIO(data))
+
+    def write_file(self, filename, fh):
+        """Like ``write``, but the data is copied out of the file ``fh``,
+        which is closed afterwards"""
+        try:
+            fh.seek(0, os.SEEK_END)
+            size = fh.tell()
+            fh.seek(0)
+            self._add(filename, size, fh)
+        finally:
+            fh.close()
+
+    def _add(self, filename, size, fh):
+        info = tarfile.TarInfo(filename)
+        info.size = size
+        info.mtime = self.mtime
+        info.mode = 0644
+        self.tar.addfile(info, fh)
+
+    def close(self):
+        self.tar.close()
+        self.fh.flush()
+        if not self.uses_stdout:
+            if self.fsync != 'none':
+                os.fsync(self.fh.fileno())
+            self.fh.close()
+
+class ZipSink(object):
+    """Writes every file into one (deflated) zip archive
+
+    Zip files keep their index at the end, so unlike tar they can't be
+    streamed to stdout.
+    """
+    uses_stdout = False
+    concurrent = False
+
+    def __init__(self, path, fsync='none'):
+        self.fh = open(path, 'wb', ARCHIVE_BUFFER_SIZE)
+        self.zip = zipfile.ZipFile(self.fh, 'w', zipfile.ZIP_DEFLATED)
+        self.date_time = time.localtime()[:6]
+        self.fsync = fsync
+
+    def write(self, filename, data):
+        info = zipfile.ZipInfo(filename, self.date_time)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0644 << 16
+        self.zip.writestr(info, data)
+
+    def write_file(self, filename, fh):
+        """Like ``write``, but the data is copied out of the file ``fh``,
+        which is closed afterwards
+
+        ``ZipFile`` can only stream files that have a name on disk into an
+        archive, so ``fh`` gets copied to one first.
+        """
+        with tempfile.NamedTemporaryFile(prefix='wp-md-') as tmp:
+            try:
+                shutil.copyfileobj(fh, tmp)
+            finally:
+                fh.close()
+            tmp.flush()
+            os.chmod(tmp.name, 0644)
+            os.utime(tmp.name, (time.mktime(self.date_time + (0, 0, -1)),) * 2)
+            self.zip.write(tmp.name, filename)
+
+    def close(self):
+        self.zip.close()
+        self.fh.flush()
+        if self.fsync != 'none':
+            os.fsync(self.fh.fileno())
+        self.fh.close()
+
+class StreamSink(object):
+    """Writes every file into one stream, one after the other
+
+    That's for formats where every post is a record in one big file rather
+    than a file of its own (jsonl). ``path`` is the file to write, or ``-``
+    for stdout. Everything gets flushed as soon as it's written, so that
+    whoever is reading the other end can get going while the rest of the
+    export is still being parsed. Any ``fsync`` other than 'none' syncs
+    the file when it's closed.
+    """
+    concurrent = False
+
+    def __init__(self, path, fsync='none'):
+        self.uses_stdout = path == '-'
+        if self.uses_stdout:
+            self.fh = sys.stdout
+        else:
+            self.fh = open(path, 'wb')
+        self.fsync = fsync
+
+    def write(self, filename, data):
+        self.fh.write(data)
+        self.fh.flush()
+
+    def write_file(self, filename, fh):
+        """Like ``write``, but the data is copied out of the file ``fh``,
+        which is closed afterwards"""
+        try:
+            shutil.copyfileobj(fh, self.fh)
+        finally:
+            fh.close()
+        self.fh.flush()
+
+    def close(self):
+        self.fh.flush()
+        if not self.uses_stdout:
+            if self.fsync != 'none':
+                os.fsync(self.fh.fileno())
+            self.fh.close()
+
+# --archive FORMAT -> a function that creates a sink writing to a path
+ARCHIVE_FORMATS = OrderedDict([
+    ('tar', lambda path, **kw: TarSink(path, **kw)),
+    ('tar.gz', lambda path, **kw: TarSink(path, 'gz', **kw)),
+    ('tar.bz2', lambda path, **kw: TarSink(path, 'bz2', **kw)),
+    ('zip', ZipSink),
+    ])
+
+# how many files can be waiting for each writer thread
+WRITES_QUEUED_PER_THREAD = 16
+
+class ThreadedSink(object):
+    """Hands the writing off to ``threads`` background threads
+
+    Rendering carries on while files are being written, until the writers
+    fall ``WRITES_QUEUED_PER_THREAD`` files behind. A file always goes to
+    the same thread, so if two posts end up with the same filename the last
+    one still wins. Sinks that can't be written to concurrently (archives)
+    only get one thread.
+
+    If a write fails, the error comes out of the next ``write`` or of
+    ``close``.
+    """
+    def __init__(self, sink, threads=2):
+        self.sink = sink
+        self.uses_stdout = sink.uses_stdout
+        if not sink.concurrent:
+            threads = 1
+        self.queues = [Queue.Queue(WRITES_QUEUED_PER_THREAD)
+                       for _ in xrange(threads)]
+        self.error = None
+        self.threads = []
+        for queue in self.queues:
+            thread = threading.Thread(target=self._writer, args=(queue,),
+                                      name='wp-md writer')
+            # don't keep a crashed export from exiting
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _writer(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            method, filename, data = item
+            if self.error is None:
+                try:
+                    getattr(self.sink, method)(filename, data)
+                except Exception:
+                    self.error = sys.exc_info()
+            elif method == 'write_file':
+                data.close()
+            # after an error everything else is just drained, so that
+            # write() never blocks on a full queue
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def write(self, filename, data):
+        self._queue('write', filename, data)
+
+    def write_file(self, filename, fh):
+        """Like ``write``, but the data is copied out of the file ``fh``,
+        which is closed afterwards (by the writer thread, so don't touch it
+        after handing it over)"""
+        self._queue('write_file', filename, fh)
+
+    def _queue(self, method, filename, data):
+        self._raise_error()
+        queue = self.queues[hash(filename) % len(self.queues)]
+        queue.put((method, filename, data))
+
+    def close(self):
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self._raise_error()
+        self.sink.close()
+
+class BufferSink(object):
+    """Holds on to files until somebody takes them out with ``drain``
+
+    This is where exporters render to, so that whoever is running them can
+    decide what happens to the files (see ``Exporter.iter_rendered``). Files
+    from ``write_file`` stay files, it's up to whoever drains them to close
+    them.
+    """
+    uses_stdout = False
+    concurrent = False
+
+    def __init__(self):
+        self.files = deque()
+
+    def write(self, filename, data):
+        self.files.append((filename, data))
+
+    def write_file(self, filename, fh):
+        self.files.append((filename, fh))
+
+    def drain(self):
+        """Yield ``(filename, data or file)`` for every file, oldest first,
+        and forget about it"""
+        files = self.files
+        while files:
+            yield files.popleft()
+
+    def close(self):
+        for _, data in self.drain():
+            if hasattr(data, 'close'):
+                data.close()
+
+# comment files are put together in memory up to this size, on disk after
+COMMENTS_SPOOL_SIZE = 1024 * 1024
+
+class CommentStore(object):
+    """Keeps comments out of the way until their post gets written
+
+    Comments show up well before their post can be written (inside of the
+    post's WXR item, or anywhere at all in a pma dump), and some posts have
+    tens of thousands of them. So every comment goes straight into one
+    temporary spool file as a line of json, and all that's kept in memory
+    is an index: post id -> an ``array`` of where its comments start.
+
+    Comments are added by the thread that reads the source while the ones
+    of earlier posts are being popped, so the spool takes turns.
+    """
+    def __init__(self):
+        self.spool = tempfile.TemporaryFile(prefix='wp-md-comments-')
+        self.offsets = {}
+        self.end = 0
+        # where the spool's file position is
+        self.pos = 0
+        # the post that the last comments were added for, and where the
+        # run of them started, see discard
+        self.last_id = None
+        self.run_start = 0
+        self.lock = threading.Lock()
+
+    def add(self, post_id, comment):
+        line = json.dumps(comment) + '\n'
+        with self.lock:
+            # always, switching from reading to writing takes a seek
+            self.spool.seek(self.end)
+            self.spool.write(line)
+            offsets = self.offsets.get(post_id)
+            if offsets is None:
+                offsets = self.offsets[post_id] = array('l')
+            offsets.append(self.end)
+            if post_id != self.last_id:
+                self.last_id = post_id
+                self.run_start = self.end
+            self.end = self.pos = self.end + len(line)
+
+    def count(self, post_id):
+        return len(self.offsets.get(post_id, ()))
+
+    def pop(self, post_id):
+        """Yield the json of every comment on ``post_id``, in the order that
+        they were added, and forget about them"""
+        spool = self.spool
+        for offset in self.offsets.pop(post_id, ()):
+            with self.lock:
+                # comments of a WXR item are all in a row, so this hardly
+                # seeks
+                if offset != self.pos:
+                    spool.seek(offset)
+                line = spool.readline()
+                self.pos = offset + len(line)
+            yield line[:-1]
+
+    def discard(self, post_id):
+        """Forget about the comments on ``post_id`` without reading them,
+        for a post that isn't going to be written
+
+        If they're the last ones that were added (a WXR item's usually are)
+        their room in the spool gets used again as well.
+        """
+        with self.lock:
+            offsets = self.offsets.pop(post_id, None)
+            if (offsets and post_id == self.last_id and
+                    offsets[0] >= self.run_start):
+                self.end = offsets[0]
+                self.last_id = None
+
+    def close(self):
+        self.spool.close()
+        self.offsets = {}
+
+class ContentSpool(object):
+    """Keeps the content of posts out of memory until the join is done
+
+    Posts don't come out of a pma_xml or sql dump until all of it has been
+    read (see ``_join_wp_tables``), so without this every one of them (and
+    every revision) is in memory at once. With it, their content goes into
+    a temporary file as it's read, and a post holds on to where its content
+    is, as ``(offset, length)``, until it's about to come out.
+    """
+    def __init__(self):
+        self.spool = tempfile.TemporaryFile(prefix='wp-md-content-')
+        self.end = 0
+
+    def add(self, content):
+        """Spool ``content``, returning what to ``get`` it back with"""
+        if not content:
+            return content
+        data = content.encode('utf-8')
+        self.spool.seek(self.end)
+        self.spool.write(data)
+        where = (self.end, len(data))
+        self.end += len(data)
+        return where
+
+    def get(self, where):
+        if not isinstance(where, tuple):
+            return where
+        self.spool.seek(where[0])
+        data = self.spool.read(where[1])
+        # ascii comes back as a str, like it went in
+        try:
+            data.decode('ascii')
+        except UnicodeDecodeError:
+            data = data.decode('utf-8')
+        return data
+
+    def close(self):
+        self.spool.close()
+
+# lives in the output directory of incremental exports
+MANIFEST_NAME = '.wp-md-manifest.json'
+
+class Manifest(object):
+    """Remembers which posts were written to an output directory, and from what
+
+    Every post gets a hash of its source fields along with everything else
+    that goes into its output: the wp-md and converter versions and the
+    output format. If the hash of a post matches the one from the last run,
+    and its files are still there, it doesn't need to be converted or written
+    again.
+
+    Call ``finish()`` once the export is done to save the new manifest and
+    deal with the files of posts that are gone from the source.
+    """
+    def __init__(self, base_dir, dest_format):
+        self.base_dir = base_dir
+        self.path = os.path.join(base_dir, MANIFEST_NAME)
+        self.dest_format = dest_format
+        self.old = {}
+        # files that were left behind by an earlier run without pruning
+        self.old_stale = []
+        if os.path.exists(self.path):
+            with open(self.path) as fh:
+                manifest = json.load(fh)
+            self.old = manifest['posts']
+            self.old_stale = manifest.get('stale', [])
+        self.posts = {}
+        self.unchanged = 0
+
+    def post_hash(self, post):
+        fields = [VERSION, CONVERTER_VERSION, self.dest_format,
+                  sorted(post.items())]
+        return hashlib.sha1(json.dumps(fields)).hexdigest()
+
+    def is_unchanged(self, post):
+        """Check whether ``post`` can be skipped, recording it either way
+
+        Posts without an u'id' get one made up from their date and title.
+        """
+        if post.get(u'id') is None:
+            post[u'id'] = u'%s %s' % (post[u'date'], post[u'title'])
+        key = unicode(post[u'id'])
+        post_hash = self.post_hash(post)
+
+        entry = self.old.get(key)
+        if (entry is not None and entry['hash'] == post_hash and
+            all(os.path.exists(os.path.join(self.base_dir, f))
+                for f in entry['files'])):
+            self.posts[key] = entry
+            self.unchanged += 1
+            return True
+
+        self.posts[key] = {'hash': post_hash, 'files': []}
+        return False
+
+    def record(self, post, filename):
+        """Note that ``filename`` was written for ``post``"""
+        self.posts[unicode(post[u'id'])]['files'].append(filename)
+
+    def record_stem(self, post, stem):
+        """Note that ``post``'s files are named after ``stem``"""
+        self.posts[unicode(post[u'id'])]['stem'] = stem
+
+    def stems(self):
+        """Which post every stem belonged to last time, ``{stem: id}``"""
+        return dict((entry['stem'], key)
+                    for key, entry in self.old.iteritems() if 'stem' in entry)
+
+    def finish(self, prune=False, partial=False):
+        """Save the manifest, and report or remove files that are stale
+
+        A file is stale if the post that it was written for is gone from the
+        source, or if that post is now written somewhere else. Stale files
+        that aren't pruned stay in the manifest so that a later run can.
+
+        If only ``partial`` export was done, posts that weren't seen this
+        time aren't gone, they're kept as they were.
+        """
+        if partial:
+            for key, entry in self.old.iteritems():
+                self.posts.setdefault(key, entry)
+        current = set(f for entry in self.posts.itervalues()
+                      for f in entry['files'])
+        vanished = [key for key in self.old if key not in self.posts]
+        stale = set(self.old_stale)
+        stale.update(f for entry in self.old.itervalues()
+                     for f in entry['files'])
+        stale = sorted(stale - current)
+        kept = []
+
+        if self.unchanged:
+            sys.stderr.write("skipped %d unchanged posts\n" % self.unchanged)
+        if vanished:
+            sys.stderr.write("%d posts are gone from the source\n"
+                             % len(vanished))
+        for filename in stale:
+            path = os.path.join(self.base_dir, filename)
+            if not os.path.exists(path):
+                continue
+            if prune:
+                os.remove(path)
+            kept.append(filename)
+        if kept and prune:
+            sys.stderr.write("removed %d stale files\n" % len(kept))
+            kept = []
+        elif kept:
+            sys.stderr.write("%d stale files were left alone, use --prune "
+                             "to remove them\n" % len(kept))
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump({'version': VERSION,
+                       'converter': CONVERTER_VERSION,
+                       'format': self.dest_format,
+                       'posts': self.posts,
+                       'stale': kept}, fh)
+        os.rename(tmp, self.path)
+        # ready for another run, without reading all of that back in
+        self.old, self.old_stale = self.posts, kept
+        self.posts = {}
+        self.unchanged = 0
+
+    def abandon(self):
+        """Forget about a run that didn't make it to ``finish()``, the next
+        one starts over from the last one that did
+
+        Except that the posts it got to might have been written already, so
+        they won't be unchanged next time, whatever their hash.
+        """
+        for key, entry in self.posts.iteritems():
+            old = self.old.get(key)
+            if old is entry:
+                continue
+            merged = dict(old or {})
+            merged.update(entry)
+            merged['hash'] = None
+            merged['files'] = entry['files'] + [
+                f for f in (old or {}).get('files', ())
+                if f not in entry['files']]
+            self.old[key] = merged
+        self.posts = {}
+        self.unchanged = 0
+
+# where the wp-md command keeps its conversion cache by default
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                         os.path.join(os.path.expanduser('~'), '.cache'),
+                         'wp-md')
+CACHE_NAME = 'conversions.sqlite'
+# how many new conversions get written before they're committed
+CACHE_COMMIT_EVERY = 500
+
+def _qualified_name(cls):
+    """``module.Class``, where this module is always wpmd, even when it's
+    being run as a script"""
+    module = 'wpmd' if cls.__module__ == __name__ else cls.__module__
+    return '%s.%s' % (module, cls.__name__)
+
+class ConversionCache(object):
+    """An sqlite database of html that has been converted to markdown before
+
+    Conversions are looked up by a hash of the html, the markdown
+    interpreter, ``CONVERTER_VERSION`` and the ``converter`` (the classes
+    that did the converting, see ``Exporter._cached``), so an upgraded
+    converter never sees stale output, and neither does a subclass that
+    converts differently. Every lookup stamps the conversion with an ever
+    increasing counter, and ``close()`` throws out the least recently used
+    conversions until the markdown in the cache adds up to less than
+    ``max_bytes``.
+
+    It belongs to the thread that created it, unless ``check_same_thread``
+    is off (see ``SharedCache``).
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=256 * 1024 * 1024,
+                 check_same_thread=True):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.path = os.path.join(cache_dir, CACHE_NAME)
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(self.path, timeout=60,
+                                  check_same_thread=check_same_thread)
+        self.db.execute('CREATE TABLE IF NOT EXISTS conversions ('
+                        ' key TEXT PRIMARY KEY,'
+                        ' markdown TEXT NOT NULL,'
+                        ' size INTEGER NOT NULL,'
+                        ' used INTEGER NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS conversions_used '
+                        'ON conversions (used)')
+        self.clock = self.db.execute(
+            'SELECT MAX(used) FROM conversions').fetchone()[0] or 0
+        self.uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(html, md_interpreter, converter=''):
+        if isinstance(html, unicode):
+            html = html.encode('utf-8')
+        return hashlib.sha1('%s\0%s\0%s\0%s' % (md_interpreter,
+                                                 CONVERTER_VERSION,
+                                                 converter,
+                                                 html)).hexdigest()
+
+    def get(self, key):
+        """Return the markdown for ``key``, or None if it isn't cached"""
+        row = self.db.execute('SELECT markdown FROM conversions WHERE key = ?',
+                              (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.clock += 1
+        self.db.execute('UPDATE conversions SET used = ? WHERE key = ?',
+                        (self.clock, key))
+        return row[0]
+
+    def put(self, key, markdown):
+        self.clock += 1
+        self.db.execute('INSERT OR REPLACE INTO conversions '
+                        'VALUES (?, ?, ?, ?)',
+                        (key, markdown, _size(markdown), self.clock))
+        self.uncommitted += 1
+        if self.uncommitted >= CACHE_COMMIT_EVERY:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def clear(self):
+        self.db.execute('DELETE FROM conversions')
+        self.db.commit()
+        self.db.execute('VACUUM')
+
+    def close(self):
+        """Evict whatever doesn't fit in ``max_bytes`` and save the rest"""
+        total = 0
+        cutoff = None
+        for used, size in self.db.execute('SELECT used, size FROM conversions '
+                                          'ORDER BY used DESC'):
+            total += size
+            if total > self.max_bytes:
+                cutoff = used
+                break
+        if cutoff is not None:
+            self.db.execute('DELETE FROM conversions WHERE used <= ?',
+                            (cutoff,))
+        self.db.commit()
+        self.db.close()
+
+class PostFilter(object):
+    """Decides which posts get exported
+
+    Every argument narrows things down, and the ones that are left out (or
+    empty) let everything through. ``since`` and ``until`` are dates like
+    the ones in WordPress exports (``2012-06-30``, ``2012-06-30 14:00``)
+    and include the day (or minute) that they name. The rest are
+    collections of acceptable ids, statuses, post types, author names and
+    classifiers, a post only needs one of its classifiers to match.
+
+    Importers should call ``accepts_row`` with whatever they have handy
+    before they build a post, and ``accepts`` once they have. ``rejected``
+    counts the posts that were thrown out, by the reason why.
+    """
+    def __init__(self, since=None, until=None, statuses=(), post_types=(),
+                 authors=(), classifiers=(), ids=()):
+        self.since = since
+        self.until = until
+        self.statuses = frozenset(statuses)
+        self.post_types = frozenset(post_types)
+        self.authors = frozenset(authors)
+        self.classifiers = frozenset(classifiers)
+        self.ids = frozenset(unicode(id) for id in ids)
+        self.rejected = OrderedDict()
+
+    def __nonzero__(self):
+        return bool(self.since or self.until or self.statuses or
+                    self.post_types or self.authors or self.classifiers or
+                    self.ids)
+
+    def _reject(self, reason):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        return False
+
+    def accepts_row(self, id, status, post_type):
+        """Check the bits of a post that are cheap to get at"""
+        if self.ids and unicode(id) not in self.ids:
+            return self._reject('id')
+        if self.statuses and status not in self.statuses:
+            return self._reject('status')
+        if self.post_types and post_type not in self.post_types:
+            return self._reject('post type')
+        return True
+
+    def accepts(self, post):
+        """Check everything about ``post``"""
+        if not self.accepts_row(post.get(u'id'), post[u'status'],
+                                post.get(u'post_type')):
+            return False
+        date = post[u'date'] or ''
+        if self.since and date[:len(self.since)] < self.since:
+            return self._reject('date')
+        if self.until and date[:len(self.until)] > self.until:
+            return self._reject('date')
+        if self.authors and post[u'author'] not in self.authors:
+            return self._reject('author')
+        if (self.classifiers and
+                self.classifiers.isdisjoint(post[u'classifiers'])):
+            return self._reject('classifier')
+        return True
+
+# --progress choices
+PROGRESS_MODES = ('lines', 'batch', 'quiet')
+# how often --progress batch says something
+PROGRESS_BATCH = 1000
 
 class Exporter(object):
     """A class that wraps up export-logic.
@@ -169,9 +2508,27 @@ class Exporter(object):
     Subclass this and write your own get_posts_from_* and export_to_* methods
     and you'll be golden.
 
+    If you'd rather have the files than have them written somewhere,
+    ``Exporter.pipeline()`` makes one that doesn't do anything by itself.
+    Its ``iter_posts``, ``iter_converted`` and ``iter_rendered`` are the
+    stages of an export, and each one is a generator that takes what the
+    one before it yields, so nothing is read, converted or rendered before
+    it's asked for::
+
+        exporter = Exporter.pipeline('nikola')
+        posts = exporter.iter_posts('blog.xml', 'wp_rss')
+        for filename, data in exporter.iter_rendered(
+                exporter.iter_converted(posts)):
+            bucket.put(filename, data)
+        exporter.close()
+
+    That's exactly what running the class does, with a sink at the end.
+
     In more detail: to write an extractor, name it `get_props_from_FORMAT`
     where FORMAT is the name of the format to extract and make sure that it
-    returns an iterable of dict-like objects that have at least the following
+    takes a source (a file name, ``-`` or a file object, or a list of them
+    to be read one after the other) and returns an iterable of dict-like
+    objects (``Post`` is the one to use) that have at least the following
     keys:
 
         - u'date'
@@ -183,36 +2540,508 @@ class Exporter(object):
         - u'categories'
         - u'classifiers'
 
-    And 'classifiers' is the union of 'tags' and 'categories'.
+    And 'classifiers' is the union of 'tags' and 'categories'. Posts should
+    also have a unique u'id' if there's one available, incremental exports
+    use it to recognize posts that they've seen before, and a u'post_type'
+    ('post', 'page'...). Extractors should drop the posts that
+    ``self.post_filter`` doesn't accept, as early as they can. If
+    ``self.comments`` is a ``CommentStore`` they should also put the
+    approved comments of every post into it, by post id. Run whatever comes
+    out of each file through ``self.source_report.reading`` to get it into
+    the throughput summary.
 
     To write an exporter, write something that takes that iterable of
     post-like things as well as a directory and creates files with those
-    things. See the various export_to_* methods herein for examples.
+    things. See the various export_to_* methods herein for examples. By the
+    time an exporter sees a post its u'content' has already been run through
+    ``_markdownify`` (possibly in another process, see ``jobs``), so it
+    doesn't need to convert anything itself. Files should be created with
+    ``_write_post_file``, which hands them to ``self.rendered`` until they
+    go off to ``sink`` (a directory, or an archive, see ``TarSink`` and
+    ``ZipSink``). Comments are written next to a post's files with
+    ``_write_comments``, which doesn't do anything unless comments are being
+    exported.
+
+    An exporter that deals with every post on its own can be an
+    ``export_post_to_FORMAT(post, base_dir)`` instead (the built in ones
+    are), and then ``iter_rendered`` hands it one post at a time and passes
+    each post's files on before it looks at the next one. An
+    ``export_to_FORMAT`` of a subclass still gets all of the posts in one
+    go, and its files come out once it's done with them.
+
+    Two posts can end up with the same slug, in the same file or (more
+    likely) in different files of a split export. ``_unique_stem`` hands out
+    the names that files are written under, and makes sure that every post
+    gets its own.
 
     There are a couple utility methods that you can use to munge up some
     text, too.
     """
 
     def __init__(self, source, outdir,
-                 source_format='wp_rss', dest_format='pelican'):
+                 source_format='wp_rss', dest_format='pelican', jobs=1,
+                 incremental=False, prune=False, stats=None,
+                 revisions='latest', sink=None, cache=None,
+                 progress='lines', post_filter=None, parse_jobs=1,
+                 comments=False, keep_html=False, max_inflight_bytes=None):
+        self._setup(outdir, dest_format, jobs=jobs, incremental=incremental,
+                    stats=stats, revisions=revisions, sink=sink, cache=cache,
+                    progress=progress, post_filter=post_filter,
+                    parse_jobs=parse_jobs, comments=comments,
+                    keep_html=keep_html,
+                    max_inflight_bytes=max_inflight_bytes)
+        # actually do the stuff:
+        self.export(source, source_format, prune)
+
+    @classmethod
+    def pipeline(cls, dest_format='pelican', **options):
+        """An exporter that doesn't export anything until it's asked to
+
+        ``options`` are the keyword arguments of the class, except that
+        ``progress`` is 'quiet' unless you say otherwise, and there's no
+        ``outdir`` unless you give it one (incremental exports need one,
+        it's where the manifest lives). Call ``close()`` once you're done
+        with it.
+        """
+        options.setdefault('progress', 'quiet')
+        exporter = cls.__new__(cls)
+        exporter._setup(dest_format=dest_format, **options)
+        return exporter
+
+    def _setup(self, outdir=None, dest_format='pelican', jobs=1,
+               incremental=False, stats=None, revisions='latest', sink=None,
+               cache=None, progress='lines', post_filter=None, parse_jobs=1,
+               comments=False, keep_html=False, max_inflight_bytes=None):
         # create an html-to-markdown processor md_interpreter is the target
         # md_interpreter. They have different ideas about what to send to
         # pygments
         md_interpreter = 'misaka' if dest_format == 'mynt' else 'markdown'
         self.processor = HtmlPreProcessor(md_interpreter)
+        self.outdir = outdir
+        self.dest_format = dest_format
+        self.jobs = jobs or multiprocessing.cpu_count()
+        # WXR files can be parsed by more than one process, too
+        self.parse_jobs = parse_jobs or multiprocessing.cpu_count()
+        # 'latest' or 'all', see _join_wp_tables
+        self.revisions = revisions
+        # the StageQueue that _read_ahead is reading into, if it is
+        self.read_queue = None
+        # which posts to export
+        self.post_filter = post_filter if post_filter is not None \
+                           else PostFilter()
+        # a ConversionCache, for when the same html gets converted again and
+        # again across runs
+        self.cache = cache
+        # where the importer puts comments, if they're wanted at all
+        self.comments = CommentStore() if comments else None
+        # whether posts hang on to their html as u'html' once they've been
+        # converted (jsonl records can include it)
+        self.keep_html = keep_html
+        # how many bytes of content export() lets into the pipeline at
+        # once, see StageQueue (pma_xml and sql spool their content, too)
+        self.max_inflight_bytes = max_inflight_bytes
+        # where exporters render files to, see iter_rendered
+        self.rendered = BufferSink()
+        # where export() writes them
+        if sink is None and outdir is not None:
+            if dest_format == 'jsonl':
+                sink = StreamSink(outdir)
+            else:
+                sink = DirectorySink(outdir)
+        self.sink = sink
+        # when the files go to stdout, chatter goes to stderr
+        self.progress_stream = sys.stderr if sink is None or sink.uses_stdout \
+                               else sys.stdout
+        # one of PROGRESS_MODES, see _progress
+        self.progress = progress
+        self.files_written = 0
+        # pass in a Stats to find out where the time went
+        self.stats = stats if stats is not None else NullStats()
+        # only incremental exports keep track of what they write
+        self.manifest = None
+        if incremental:
+            if outdir is None:
+                raise ValueError("incremental exports need an outdir")
+            self.manifest = Manifest(outdir, dest_format)
+        # file name stem -> the id of the post that it belongs to, which
+        # starts out with last time's, so that unchanged posts that get
+        # skipped keep theirs
+        self.stems = {}
+        if self.manifest is not None:
+            self.stems = self.manifest.stems()
+        # how fast each of the sources was read
+        self.source_report = SourceReport()
 
-        # actually do the stuff:
+    def export(self, source, source_format='wp_rss', prune=False):
+        """Run the whole pipeline from ``source`` into ``self.sink``, and
+        report on it
+
+        The stages run at the same time: the source is parsed (and checked
+        against the manifest) by a thread of its own, see ``_read_ahead``,
+        while this one converts the posts (or hands them to ``self.jobs``
+        processes), renders them and passes their files on to the sink,
+        which can have threads of its own (``ThreadedSink``). Every stage is
+        only ever a bounded queue ahead of the next one, and with
+        ``self.max_inflight_bytes`` the reader also waits while that much
+        content is somewhere in between.
+        """
+        queue = StageQueue(limit=self.max_inflight_bytes)
+        reader = self._read_ahead(source, source_format, queue)
+        posts = self.stats.timed('convert', self.iter_converted(reader),
+                                 lambda post: _size(post['content']))
+        posts = self._giving_back(posts, queue)
+        self.stats.enter('render')
+        try:
+            for filename, data in self._iter_rendered(posts):
+                self.stats.enter('write')
+                try:
+                    if isinstance(data, str):
+                        self.sink.write(filename, data)
+                    else:
+                        self.sink.write_file(filename, data)
+                finally:
+                    self.stats.exit()
+            # a half-written archive shouldn't look like a complete one, so
+            # this is skipped if anything goes wrong
+            self.stats.enter('write')
+            try:
+                self.sink.close()
+            finally:
+                self.stats.exit()
+        finally:
+            self.stats.exit()
+            # stops the reader, if we're bailing out
+            reader.close()
+            # whatever got converted is still good
+            self.close()
+        if queue.limit:
+            self.stats.count('reader waits for --max-inflight-bytes',
+                             queue.stalls)
+            self.stats.count('peak bytes in flight', queue.peak)
+        if self.progress == 'batch':
+            self._report_written()
+        if (len(self.source_report.sources) > 1 and
+                self.progress != 'quiet'):
+            sys.stderr.write(self.source_report.summary())
+
+        filtered = sum(self.post_filter.rejected.itervalues())
+        if filtered:
+            sys.stderr.write("skipped %d posts that didn't match the "
+                             "filters\n" % filtered)
+        for reason, count in self.post_filter.rejected.iteritems():
+            self.stats.count('posts filtered out by %s' % reason, count)
+
+        if self.manifest is not None:
+            self.stats.count('unchanged posts skipped',
+                             self.manifest.unchanged)
+            self.stats.enter('manifest')
+            try:
+                # posts that were filtered out are still there
+                self.manifest.finish(prune, partial=bool(self.post_filter))
+            finally:
+                self.stats.exit()
+
+    def _read_ahead(self, source, source_format, queue):
+        """Yield the posts of ``source`` that need to be exported, as a
+        thread of their own reads them
+
+        That's the parse and manifest stages, which get as far ahead of
+        whoever is taking the posts from here as ``queue`` (a
+        ``StageQueue``) lets them. Time spent waiting for them is 'parse
+        (waited for)', the thread's own stats are merged in once it's done.
+        If this stops early, the thread is stopped too: at the next post it
+        puts in, or the next row of a dump (``self.read_queue``), which has
+        to be read to the end before any posts come out of it.
+        """
+        stats = self.stats if isinstance(self.stats, NullStats) else Stats()
+        def read():
+            try:
+                posts = stats.timed('parse',
+                                    self.iter_posts(source, source_format),
+                                    lambda post: _size(post['content']))
+                if self.manifest is not None:
+                    posts = stats.timed('manifest', (
+                        post for post in posts
+                        if not self.manifest.is_unchanged(post)))
+                for post in posts:
+                    if not queue.put((post, None), _size(post['content'])):
+                        return
+                queue.put((None, None))
+            except Cancelled:
+                pass
+            except Exception:
+                queue.put((None, sys.exc_info()))
+        self.read_queue = queue
+        thread = threading.Thread(target=read, name='wp-md reader')
+        # don't keep a crashed export from exiting
+        thread.daemon = True
+        thread.start()
+
+        def received():
+            while True:
+                post, error = queue.get()
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                if post is None:
+                    return
+                yield post
+        try:
+            for post in self.stats.timed('parse (waited for)', received()):
+                yield post
+        finally:
+            queue.cancel()
+            thread.join(0xFFFF)
+            self.read_queue = None
+            if stats is not self.stats:
+                self.stats.merge(stats.drain())
+
+    @staticmethod
+    def _giving_back(posts, queue):
+        """Yield ``posts``, and give each one back to ``queue`` once it's
+        been rendered and written, which it has by the time that the next
+        one is asked for"""
+        posts = iter(posts)
+        while True:
+            try:
+                post = next(posts)
+            except StopIteration:
+                return
+            yield post
+            queue.give_back()
+
+    def close(self):
+        """Let go of the conversion cache and the comments that didn't get
+        written, once there's nothing left to export"""
+        if self.cache is not None:
+            self.stats.count('conversion cache hits', self.cache.hits)
+            self.stats.count('conversion cache misses', self.cache.misses)
+            self.cache.close()
+            self.cache = None
+        if self.comments is not None:
+            self.comments.close()
+            self.comments = None
+        self.rendered.close()
+
+############################################################################
+    # the pipeline
+    def iter_posts(self, source, source_format='wp_rss'):
+        """Yield the posts in ``source``, with ``get_posts_from_FORMAT``
+
+        With comments, every post gets told how many it has.
+        """
         posts = getattr(self, 'get_posts_from_%s' % source_format)(source)
-        getattr(self, 'export_to_%s' % dest_format)(posts, outdir)
+        if self.comments is not None:
+            posts = self._count_comments(posts)
+        return posts
+
+    def iter_converted(self, posts):
+        """Yield ``posts`` with their u'content' converted to markdown, see
+        ``_iter_converted``
+
+        With ``self.keep_html`` the html is kept as the post's u'html'.
+        """
+        if self.keep_html:
+            posts = self._keeping_html(posts)
+        return self._iter_converted(posts)
+
+    @staticmethod
+    def _keeping_html(posts):
+        for post in posts:
+            post[u'html'] = post[u'content']
+            yield post
+
+    def iter_rendered(self, posts):
+        """Yield ``(filename, data)`` for every file that the exporter for
+        ``self.dest_format`` renders out of ``posts``
+
+        ``filename`` is relative to wherever the files would be written and
+        ``data`` is the file's contents, as (utf-8) bytes. Every post's
+        files come out before the next post is even looked at.
+        """
+        for filename, data in self._iter_rendered(posts):
+            if not isinstance(data, str):
+                fh = data
+                try:
+                    data = fh.read()
+                finally:
+                    fh.close()
+            yield filename, data
+
+    def _iter_rendered(self, posts):
+        """Like ``iter_rendered``, but big files (comments) come out as an
+        open file, which whoever takes it has to close"""
+        base_dir = self.outdir or ''
+        export_post = self._export_post()
+        if export_post is None:
+            # an exporter of a subclass's own, that wants all of the posts
+            getattr(self, 'export_to_%s' % self.dest_format)(posts, base_dir)
+            for item in self.rendered.drain():
+                yield item
+            return
+        for post in posts:
+            export_post(post, base_dir)
+            for item in self.rendered.drain():
+                yield item
+
+    def _export_post(self):
+        """``export_post_to_FORMAT`` for ``self.dest_format``, or None if
+        there isn't one, or a subclass overrides ``export_to_FORMAT`` below
+        it (it might not do a post at a time, or write anything the way
+        ``export_post_to_FORMAT`` does)"""
+        def defined_by(name):
+            for cls in type(self).__mro__:
+                if name in cls.__dict__:
+                    return cls
+        per_post = defined_by('export_post_to_%s' % self.dest_format)
+        whole = defined_by('export_to_%s' % self.dest_format)
+        if per_post is None or (whole is not None and
+                                not issubclass(per_post, whole)):
+            return None
+        return getattr(self, 'export_post_to_%s' % self.dest_format)
 
 ############################################################################
     # utility functions
     def _markdownify(self, content):
         """Convert some pseudo-html into reasonably pleasant text
         """
-        self.processor.reset()
-        self.processor.feed(content)
-        return self.processor.readmd()
+        markdown, path = self.processor.convert(content)
+        self.stats.count('%s conversions' % path)
+        return markdown
+
+    def _iter_converted(self, posts):
+        """Markdownify the content of every post in ``posts``
+
+        Posts come back out in the order that they went in. If ``self.jobs``
+        is more than one the conversions are farmed out to a pool of worker
+        processes, and up to ``PENDING_PER_JOB`` posts per worker are read
+        ahead to keep them busy. Posts whose content is in ``self.cache``
+        don't get converted at all.
+        """
+        if self.jobs <= 1:
+            for post in posts:
+                if post['content'] is not None:
+                    key, markdown = self._cached(post['content'])
+                    if markdown is None:
+                        markdown = self._markdownify(post['content'])
+                        if key is not None:
+                            self.cache.put(key, markdown)
+                    post['content'] = markdown
+                yield post
+            return
+
+        pool = multiprocessing.Pool(self.jobs, _init_worker,
+                                    (type(self), self.processor.md_interpreter,
+                                     not isinstance(self.stats, NullStats)))
+        try:
+            pending = deque()
+            for post in posts:
+                key = result = None
+                if post['content'] is not None:
+                    key, markdown = self._cached(post['content'])
+                    if markdown is not None:
+                        post['content'] = markdown
+                    else:
+                        result = pool.apply_async(_markdownify_in_worker,
+                                                  (post['content'],))
+                        # the worker has its own copy now
+                        post['content'] = u''
+                pending.append((post, result, key))
+                if len(pending) >= self.jobs * PENDING_PER_JOB:
+                    yield self._finish_conversion(*pending.popleft())
+            while pending:
+                yield self._finish_conversion(*pending.popleft())
+            pool.close()
+        finally:
+            # only does anything if we're bailing out early
+            pool.terminate()
+            pool.join()
+
+    def _finish_conversion(self, post, result, key):
+        """Wait for a worker to convert ``post``"""
+        if result is not None:
+            # AsyncResult.get() can't be interrupted without a timeout
+            post['content'], worker_stats = result.get(0xFFFF)
+            self.stats.merge(worker_stats, ' (workers)')
+            if key is not None:
+                self.cache.put(key, post['content'])
+        return post
+
+    def _count_comments(self, posts):
+        """Tell every post how many comments it has, in u'comments'
+
+        It's part of the post as far as incremental exports are concerned,
+        so new comments get a post written again.
+        """
+        for post in posts:
+            post[u'comments'] = self.comments.count(post.get(u'id'))
+            yield post
+
+    def _cached(self, content):
+        """Look ``content`` up in the cache
+
+        Returns the cache key and the cached markdown, either of which can be
+        None if there's no cache or the content isn't in it.
+        """
+        if self.cache is None:
+            return None, None
+        # subclasses (and other processors) can convert html differently
+        converter = '%s %s' % (_qualified_name(type(self)),
+                               _qualified_name(type(self.processor)))
+        key = self.cache.key(content, self.processor.md_interpreter,
+                             converter)
+        return key, self.cache.get(key)
+
+    def _write_post_file(self, post, base_dir, filename, text):
+        """Write ``text`` as utf-8 to ``filename`` inside of ``base_dir``
+
+        Exporters should write everything through here, so that incremental
+        exports know which files belong to which post, and so that it ends
+        up in ``self.rendered`` and from there wherever the pipeline sends
+        it, which might not be ``base_dir`` at all.
+        """
+        self.stats.add('render', 1, _size(text))
+        data = text.encode('utf-8')
+        self.rendered.write(filename, data)
+        self._wrote(post, filename, len(data))
+
+    def _write_comments(self, post, base_dir, stem):
+        """Write the comments on ``post`` to ``stem + '.comments.json'``
+
+        That's a json list of objects with the fields in ``COMMENT_COLUMNS``
+        (except for 'approved', they all are), oldest comment first (well,
+        in the order that the source has them).
+        Nothing gets written unless comments are being exported and the post
+        has some. The file is put together a comment at a time, and goes to
+        disk once it's bigger than ``COMMENTS_SPOOL_SIZE``, so a post with
+        any number of comments takes the same amount of memory.
+        """
+        if self.comments is None or not post.get(u'comments'):
+            return
+        filename = stem + '.comments.json'
+        fh = tempfile.SpooledTemporaryFile(COMMENTS_SPOOL_SIZE,
+                                           prefix='wp-md-comments-')
+        separator = '[\n'
+        for comment in self.comments.pop(post[u'id']):
+            fh.write(separator)
+            fh.write(comment)
+            separator = ',\n'
+        fh.write('\n]\n')
+        size = fh.tell()
+        fh.seek(0)
+        self.rendered.write_file(filename, fh)
+        self.stats.count('comments written', post[u'comments'])
+        self._wrote(post, filename, size)
+
+    def _wrote(self, post, filename, size):
+        """Keep track of a file of ``size`` bytes that was written for
+        ``post``"""
+        self.stats.add('write', 1, size)
+        self.files_written += 1
+        if (self.progress == 'batch' and
+                self.files_written % PROGRESS_BATCH == 0):
+            self._report_written()
+        if self.manifest is not None:
+            self.manifest.record(post, filename)
 
     @staticmethod
     def _slugify(txt):
@@ -222,9 +3051,50 @@ class Exporter(object):
             .replace(' ', '-')\
             .replace('.', '')
 
+    def _progress(self, message):
+        """Tell the user about a file that's being written
+
+        That's a line per file with ``progress='lines'``. 'batch' only says
+        how many files have been written every ``PROGRESS_BATCH`` files, and
+        'quiet' doesn't say anything.
+        """
+        if self.progress == 'lines':
+            print >>self.progress_stream, message
+
+    def _report_written(self):
+        print >>self.progress_stream, '%d files written' % self.files_written
+
+    def _unique_stem(self, post, stem):
+        """Claim ``stem`` for the files of ``post``, or ``stem-2``,
+        ``stem-3``... if another post got there first"""
+        owner = post.get(u'id')
+        if owner is None:
+            owner = u'%s %s' % (post[u'date'], post[u'title'])
+        owner = unicode(owner)
+        claimed = stem
+        n = 1
+        while self.stems.setdefault(claimed, owner) != owner:
+            n += 1
+            claimed = '%s-%d' % (stem, n)
+        if self.manifest is not None:
+            self.manifest.record_stem(post, claimed)
+        return claimed
+
+    def _post_slug(self, post, txt):
+        """Slugify ``txt`` for ``post``, keeping revisions apart from the
+        post that they belong to"""
+        slug = self._slugify(txt)
+        if post.get(u'revision_of') is not None:
+            slug += '-revision-%s' % post[u'id']
+        return slug
+
 ############################################################################
     # export functions
     def export_to_pelican(self, posts, base_dir):
+        for post in posts:
+            self.export_post_to_pelican(post, base_dir)
+
+    def export_post_to_pelican(self, post, base_dir):
         template = u"""Title: %(title)s
 Slug: %(slug)s
 Author: %(author)s
@@ -236,54 +3106,55 @@ Category: %(category)s
 %(content)s
 """
         j = os.path.join
-        for post in posts:
-            if post['content'] is None:
-                continue
+        if post['content'] is None:
+            return
 
-            post['slug'] = self._slugify(post['title'])
+        post['slug'] = self._unique_stem(
+            post, self._post_slug(post, post['title']))
 
-            post['date'] = post['date'][:-3]
-            post['content'] = self._markdownify(post['content'])
+        post['date'] = post['date'][:-3]
 
-            # in pelican, each post can only be in ONE category, so put all
-            # but the first into tags
-            if len(post['categories']) > 0:
-                post['category'] = post[u'categories'][0]
-            else:
-                post['category'] = ''
-            post['tags'] = ', '.join(post[u'tags'] +
-                                     post['categories'][1:])
+        # in pelican, each post can only be in ONE category, so put all
+        # but the first into tags
+        if len(post['categories']) > 0:
+            post['category'] = post[u'categories'][0]
+        else:
+            post['category'] = ''
+        post['tags'] = ', '.join(post[u'tags'] +
+                                 post['categories'][1:])
 
-            if post['status'] == 'publish':
-                post['status'] = 'published'
+        if post['status'] == 'publish':
+            post['status'] = 'published'
 
-            out = j(base_dir, post['slug'] + '.md')
-            with open(out, 'w') as fh:
-                print ('writing (%s) ' % post['status']) + out
-                fh.write((template % post).encode('utf-8'))
+        filename = post['slug'] + '.md'
+        self._progress(('writing (%s) ' % post['status']) +
+                       j(base_dir, filename))
+        self._write_post_file(post, base_dir, filename, template % post)
+        self._write_comments(post, base_dir, post['slug'])
 
     def export_to_nikola(self, posts, base_dir):
+        for post in posts:
+            self.export_post_to_nikola(post, base_dir)
+
+    def export_post_to_nikola(self, post, base_dir):
         meta_template = u"""%(title)s
 %(safe_title)s
 %(date)s
 %(classifiers)s
 """
-        j = os.path.join
-        for post in posts:
-            if post['content'] is None:
-                continue
-
-            t = post['safe_title'] = self._slugify(post['title'])
+        if post['content'] is None:
+            return
 
-            post['date'] = post['date'].replace('-', '/')[:-3]
-            post['content'] = self._markdownify(post['content'])
-            post['classifiers'] = ', '.join(post['classifiers'])
+        t = post['safe_title'] = self._unique_stem(
+            post, self._post_slug(post, post['title']))
 
-            with open(j(base_dir, t + '.meta'), 'w') as metafh:
-                metafh.write((meta_template % post).encode('utf-8'))
+        post['date'] = post['date'].replace('-', '/')[:-3]
+        post['classifiers'] = ', '.join(post['classifiers'])
 
-            with open(j(base_dir, t + '.md'), 'w') as postfh:
-                postfh.write(post['content'].encode('utf-8'))
+        self._write_post_file(post, base_dir, t + '.meta',
+                              meta_template % post)
+        self._write_post_file(post, base_dir, t + '.md', post['content'])
+        self._write_comments(post, base_dir, t)
 
     def export_to_mynt(self, posts, base_dir):
         """Write blog stuff to mynt-like files
@@ -296,7 +3167,11 @@ Category: %(category)s
 
         All of these should be in a format ready to write.
         """
+        for post in posts:
+            self.export_post_to_mynt(post, base_dir)
 
+    def export_post_to_mynt(self, post, base_dir):
+        """Write one post to a mynt-like file, see ``export_to_mynt``"""
         template = u"""---
 layout: post.html
 title: %(title)s
@@ -305,163 +3180,997 @@ tags: %(classifiers)s
 
 %(content)s
 """
-        opj = os.path.join
+        if post['content'] is None:
+            return
+        stem = post['date'] + '-' + post['title']
+        if post.get(u'revision_of') is None:
+            # the dot in '.md' has always been slugified away, and
+            # renaming everybody's posts now would be worse
+            stem = self._slugify(stem + '.md')
+            extension = ''
+        else:
+            stem = self._post_slug(post, stem)
+            extension = '.md'
+        stem = self._unique_stem(post, stem)
 
-        for post in posts:
-            if post['content'] is None:
-                continue
-            filename = post['date'] + '-' + post['title'] + '.md'
-            filename = self._slugify(filename)
+        # wordpress creates drafts with statuses draft or auto-draft
+        # mynt ignores files that start with an underscore
+        if 'draft' in post['status']:
+            stem = '_' + stem
+        filename = stem + extension
 
-            # wordpress creates drafts with statuses draft or auto-draft
-            # mynt ignores files that start with an underscore
-            if 'draft' in post['status']:
-                filename = '_' + filename
+        # yaml has weird ideas about escape chars
+        post['title'] = repr(post['title']).replace(
+            r"\'", "''").replace("\\", "")
 
-            # yaml has weird ideas about escape chars
-            post['title'] = repr(post['title']).replace(
-                r"\'", "''").replace("\\", "")
+        self._write_post_file(post, base_dir, filename, template % post)
+        self._write_comments(post, base_dir, stem)
 
-            post['content'] = self._markdownify(post['content'])
+    def export_to_jsonl(self, posts, base_dir):
+        """Write every post as a line of json (JSON Lines), for feeding to
+        something other than a static site generator
 
-            with open(opj(base_dir, filename), 'w') as fh:
-                out = template % post
-                fh.write(out.encode('utf-8'))
+        A record has the post's metadata, its slug and its markdown as
+        u'content', plus the html it came from as u'html' with
+        ``keep_html``. With comments, u'comments' is the list of them
+        instead of a count. Every record is a "file" named after the slug,
+        and it's ``StreamSink`` that puts them all into one.
+        """
+        for post in posts:
+            self.export_post_to_jsonl(post, base_dir)
+
+    def export_post_to_jsonl(self, post, base_dir):
+        """Write one post's record, see ``export_to_jsonl``"""
+        if post['content'] is None:
+            return
+        slug = self._unique_stem(
+            post, self._post_slug(post, post['title'] or u''))
+        record = OrderedDict()
+        for key in ('id', 'title', 'date', 'author', 'status',
+                    'post_type', 'tags', 'categories', 'classifiers',
+                    'revision_of'):
+            if post.get(key) is not None:
+                record[key] = post[key]
+        record['slug'] = slug
+        record['content'] = post['content']
+        if self.keep_html:
+            record['html'] = post.get(u'html')
+        if self.comments is not None:
+            record['comments'] = [
+                json.loads(comment)
+                for comment in self.comments.pop(post[u'id'])]
+            self.stats.count('comments written', len(record['comments']))
+        self._write_post_file(post, base_dir, slug + '.json',
+                              json.dumps(record, ensure_ascii=False) +
+                              '\n')
 
 ############################################################################
     # import functions
-    @staticmethod
-    def get_posts_from_pma_xml(source):
+    def get_posts_from_pma_xml(self, source):
         """Convert PHPMyAdmin xml to nice python Dicts
 
         this is where I implement database joins on top of xml.
 
         I try to be nice, and this is what I get? Sheesh. I hope somebody who
         doesn't have a mysql driver is grateful.
+
+        The dump is streamed exactly once, see ``_join_wp_tables`` for the
+        actual joining. A dump that's been split up into several files is
+        joined as a whole, so it doesn't matter which tables end up where.
         """
-        root = ET.parse(source).getroot()
+        return self._join_sources(source, _iter_pma_rows)
 
-        els = root.findall(".//table[@name='wp_posts']")
-        posts = OrderedDict()
+    def get_posts_from_sql(self, source):
+        """Read posts out of a mysqldump file (``.sql``), without a database
+
+        The same tables and joins as ``get_posts_from_pma_xml``, and the same
+        posts come out. The dump is tokenized as it streams past (see
+        ``_iter_sql_rows``), so only the join tables end up in memory.
+        """
+        return self._join_sources(source, _iter_sql_rows)
 
+    def _join_sources(self, source, iter_rows):
+        """Join the WordPress tables that ``iter_rows(source, tables)``
+        finds in every one of the sources"""
+        tables = WP_TABLES
+        if self.comments is not None:
+            tables = tables | frozenset(['wp_comments'])
+        rows = chain.from_iterable(
+            self.source_report.reading(each, iter_rows(each, tables), 'rows')
+            for each in _source_list(source))
+        if self.read_queue is not None:
+            # no post comes out until the whole dump has been read, so an
+            # export that's called off can't wait for the next one
+            rows = self.read_queue.unless_cancelled(rows)
+        if not self.max_inflight_bytes:
+            return self._join_wp_tables(rows, self.revisions,
+                                        self.post_filter, self.comments)
+        # a cap on memory is no good if the whole dump is in it
+        spool = ContentSpool()
+        return _closing(spool, self._join_wp_tables(
+            rows, self.revisions, self.post_filter, self.comments, spool))
+
+    @staticmethod
+    def _join_wp_tables(rows, revisions='latest', post_filter=None,
+                        comments=None, spool=None):
+        """Join raw WordPress table rows into posts
+
+        ``rows`` is an iterable of ``(table_name, {column: value})`` pairs,
+        in whatever order the dump has them, and it only gets consumed once.
+        The join tables go into hash indexes as they stream past. Dumps are
+        usually sorted by table name, so ``wp_posts`` shows up before the
+        terms and users that it refers to: posts are only resolved once
+        every row has been seen.
+
+        A post's newest revision (by date) replaces its content, title, date,
+        author and status. Older revisions are dropped the moment that a newer
+        one turns up, so a post with fifty revisions only ever holds on to
+        one.
+        With ``revisions='all'`` the older revisions are kept too, and each
+        comes out as a draft of its own right after its post, with a
+        u'revision_of' key holding the id of the post. Revisions of posts
+        that aren't in the dump are ignored.
+
+        ``post_filter`` throws out posts (and their revisions) that it
+        doesn't like as soon as it can: by id, status and type as their row
+        goes past, the rest once the joins are done.
+
+        ``wp_comments`` rows go straight into ``comments`` (a
+        ``CommentStore``) as they stream past, which makes it the index that
+        they're joined to their posts with.
+
+        With a ``spool`` (a ``ContentSpool``) the content of posts and
+        revisions waits in there instead of in memory, and is only read back
+        as they come out.
+        """
+        if post_filter is None:
+            post_filter = PostFilter()
+        posts = OrderedDict()
+        rejected = set() # ids of posts that didn't get past the filter
+        latest = {} # post id -> its newest revision
+        history = defaultdict(list) # post id -> [revision], for 'all'
         terms = {}
-        for term in root.findall(".//table[@name='wp_terms']"):
-            key = term.find("./column[@name='term_id']").text
-            tag = term.find("./column[@name='slug']").text
-            terms[key] = tag
-
-        taxes = {} # term taxonomy is the relationship between terms and parents
-        categories  = {}
-        for taxonomy in root.findall(".//table[@name='wp_term_taxonomy']"):
-            tax = taxonomy.find("./column[@name='taxonomy']").text
-            if tax == 'post_tag':
-                key = taxonomy.find("./column[@name='term_taxonomy_id']").text
-                term_id = taxonomy.find("./column[@name='term_id']").text
-                taxes[key] = terms[term_id]
+        taxonomies = {} # term_taxonomy_id -> (taxonomy, term_id)
+        users = {}
+        relationships = defaultdict(list) # object_id -> [term_taxonomy_id]
+
+        for table, row in rows:
+            if table == 'wp_posts':
+                if row['post_type'] != 'revision':
+                    if not post_filter.accepts_row(row['ID'],
+                                                   row['post_status'],
+                                                   row['post_type']):
+                        rejected.add(row['ID'])
+                        continue
+                elif row['post_parent'] in rejected:
+                    continue
 
-            elif tax == 'category':
-                key = taxonomy.find("./column[@name='term_taxonomy_id']").text
-                term_id = taxonomy.find("./column[@name='term_id']").text
+                content = row['post_content']
+                if spool is not None:
+                    content = spool.add(content)
+                post = Post(
+                    id=row['ID'],
+                    date=row['post_date'],
+                    author=row['post_author'], # resolved below
+                    content=content,
+                    title=row['post_title'],
+                    status=row['post_status'],
+                    post_type=row['post_type'],
+                    )
+                if row['post_type'] != 'revision':
+                    posts[post[u'id']] = post
+                    continue
+
+                parent = row['post_parent']
+                if revisions == 'all':
+                    history[parent].append(post)
+                # same second? the higher id was saved later
+                newest = latest.get(parent)
+                key = _revision_key(post)
+                if newest is None or key > _revision_key(newest):
+                    latest[parent] = post
+            elif table == 'wp_term_relationships':
+                relationships[row['object_id']].append(
+                    row['term_taxonomy_id'])
+            elif table == 'wp_term_taxonomy':
+                # term taxonomy is the relationship between terms and parents
+                if row['taxonomy'] in ('post_tag', 'category'):
+                    taxonomies[row['term_taxonomy_id']] = (row['taxonomy'],
+                                                           row['term_id'])
+            elif table == 'wp_terms':
+                terms[row['term_id']] = row['slug']
+            elif table == 'wp_users':
+                users[row['ID']] = row['display_name']
+            elif table == 'wp_comments':
+                if row['comment_post_ID'] in rejected:
+                    continue
+                comment = _comment(row)
+                if comment is not None:
+                    comments.add(row['comment_post_ID'], comment)
+
+        if comments is not None:
+            # dumps usually have the comments before the posts
+            for id in rejected:
+                comments.discard(id)
+
+        # everything that posts depend on has been seen, now do the joins
+        categories = {}
+        taxes = {}
+        for key, (tax, term_id) in taxonomies.iteritems():
+            if tax == 'category':
                 categories[key] = terms[term_id]
+            else:
+                taxes[key] = terms[term_id]
 
-        users = {}
-        for user_el in root.findall(".//table[@name='wp_users']"):
-            id  = user_el.find("./column[@name='ID']").text
-            name = user_el.find("./column[@name='display_name']").text
-            users[id] = name
-
-        all_tags = {}
-        all_tags.update(taxes)
-        all_tags.update(categories)
-        post_classifiers = defaultdict(list)
-        post_cats = defaultdict(list)
-        post_tags = defaultdict(list)
-        for relation in root.findall(".//table[@name='wp_term_relationships']"):
-            obj_id  = relation.find("./column[@name='object_id']").text
-            term_id = relation.find("./column[@name='term_taxonomy_id']").text
+        while posts:
+            id, post = posts.popitem(last=False)
+            post[u'classifiers'] = []
+            post[u'categories'] = []
+            post[u'tags'] = []
+            for term_id in relationships.pop(id, ()):
+                if term_id in categories:
+                    post[u'classifiers'].append(categories[term_id])
+                    post[u'categories'].append(categories[term_id])
+                elif term_id in taxes:
+                    post[u'classifiers'].append(taxes[term_id])
+                    post[u'tags'].append(taxes[term_id])
+
+            revision = latest.pop(id, None)
+            # the newest one is already the post itself
+            older = sorted((each for each in history.pop(id, ())
+                            if each is not revision), key=_revision_key)
+            if revision is not None:
+                for key in (u'date', u'author', u'content', u'title'):
+                    post[key] = revision[key]
+                if revision[u'status'] != u'inherit':
+                    post[u'status'] = revision[u'status']
+            post[u'author'] = users[post[u'author']]
+            if not post_filter.accepts(post):
+                if comments is not None:
+                    comments.discard(id)
+                continue
+            # exporters are allowed to mangle the post that they get
+            classifiers = [(key, list(post[key])) for key in
+                           (u'classifiers', u'categories', u'tags')]
+            if spool is not None:
+                post[u'content'] = spool.get(post[u'content'])
+            yield post
+
+            for revision in older:
+                if spool is not None:
+                    revision[u'content'] = spool.get(revision[u'content'])
+                revision[u'author'] = users[revision[u'author']]
+                revision[u'status'] = u'draft'
+                revision[u'revision_of'] = id
+                for key, values in classifiers:
+                    revision[key] = list(values)
+                yield revision
+
+    def get_posts_from_wp_rss(self, filename):
+        """Yield a post for every ``channel/item`` in a WordPress eXtended RSS
+        file (or a list of them, like the pieces of a split export)
+
+        The file is read with ``iterparse`` and every item is thrown away as
+        soon as its post has been built, so memory use doesn't depend on the
+        size of the export. Items that ``self.post_filter`` doesn't want are
+        thrown away before they're turned into posts at all, if their id,
+        status and type are enough to tell.
+
+        With ``self.parse_jobs`` the files are cut up into shards that are
+        parsed by a pool of processes, see ``_iter_wp_rss_sharded``.
+
+        Comments are items' ``<wp:comment>`` elements, and each of them is
+        handed to ``self.comments`` and thrown away as soon as it's been
+        parsed, long before the end of its item.
+        """
+        filenames = _source_list(filename)
+        if self.parse_jobs > 1:
+            if self.comments is not None:
+                sys.stderr.write("--parse-jobs can't export comments, "
+                                 "parsing with one process\n")
+            elif all(_is_plain_file(each) for each in filenames):
+                return self._iter_wp_rss_sharded(filenames)
+            else:
+                sys.stderr.write("--parse-jobs needs uncompressed files, "
+                                 "parsing with one process\n")
+        return chain.from_iterable(
+            self.source_report.reading(each, self._iter_wp_items(each))
+            for each in filenames)
+
+    def _iter_wp_items(self, source):
+        post_filter = self.post_filter
+        comments = self.comments
+        wanted = (WXR_ITEM,) if comments is None else (WXR_ITEM, WXR_COMMENT)
+        for post_el, parent in _iter_elements(
+                source, lambda path: path[1:] in wanted, parents=True):
+            if post_el.tag == WXR_COMMENT[-1]:
+                # its item's post_id has already been parsed
+                comment = _comment(dict((child.tag, child.text)
+                                        for child in post_el),
+                                   WXR_COMMENT_COLUMNS)
+                if comment is not None:
+                    comments.add(parent.findtext(wp('post_id')), comment)
+                continue
+            post_id = post_el.findtext(wp('post_id'))
+            if not post_filter.accepts_row(post_id,
+                                           post_el.findtext(wp('status')),
+                                           post_el.findtext(wp('post_type'))):
+                if comments is not None:
+                    comments.discard(post_id)
+                continue
+            post = self._post_from_wp_item(post_el)
+            if post_filter.accepts(post):
+                yield post
+            elif comments is not None:
+                comments.discard(post_id)
+
+    def _iter_wp_rss_sharded(self, filenames):
+        """Parse WXR files with ``self.parse_jobs`` processes
+
+        Each file is mapped into memory and scanned for item boundaries
+        (``_wxr_shards``), and every worker parses the shards that it's
+        handed as a small WXR file of their own: the original header, the
+        items, and closing tags. All of the files share the one pool, and
+        the next file's shards are handed out while the last ones of the
+        file before are still being parsed. Posts come back in the same
+        order as they would from a single process.
+        """
+        pool = multiprocessing.Pool(self.parse_jobs, _init_shard_worker,
+                                    (type(self), self.post_filter))
+        try:
+            # (filename, AsyncResult), and (filename, None) after the last
+            # shard of a file
+            pending = deque()
+            for filename in filenames:
+                self.source_report.start(filename)
+                with open(filename, 'rb') as fh:
+                    data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for start, end in _wxr_shards(data, SHARD_SIZE):
+                        pending.append((filename, pool.apply_async(
+                            _parse_shard_in_worker, (filename, start, end))))
+                        if len(pending) >= self.parse_jobs * PENDING_PER_JOB:
+                            for post in self._finish_shard(*pending.popleft()):
+                                yield post
+                finally:
+                    data.close()
+                pending.append((filename, None))
+            while pending:
+                for post in self._finish_shard(*pending.popleft()):
+                    yield post
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _finish_shard(self, filename, result):
+        """Wait for a worker to parse a shard of ``filename``, and return its
+        posts"""
+        if result is None:
+            self.source_report.finish(filename)
+            return ()
+        posts, rejected = result.get(0xFFFF)
+        for reason, count in rejected.iteritems():
+            self.post_filter.rejected[reason] = \
+                self.post_filter.rejected.get(reason, 0) + count
+        self.source_report.add(filename, len(posts))
+        return posts
+
+    @staticmethod
+    def _post_from_wp_item(post_el):
+        """Turn a single WXR ``<item>`` element into a Post"""
+        post = Post()
+        post['id'] = post_el.findtext(wp('post_id'))
+        post['date']  = post_el.find(wp('post_date')).text
+        post['author'] = post_el.find(dc('creator')).text
+        post['content'] = post_el.find(content('encoded')).text
+        post['title'] = post_el.find('title').text
+        post['status'] = post_el.find(wp('status')).text
+        post['post_type'] = post_el.findtext(wp('post_type'))
+        post['categories'] = []
+        post['tags'] = []
+        post['classifiers'] = []
+        for classifier in post_el.findall('category'):
+            cl = classifier.text
+            post['classifiers'].append(cl)
+            if classifier.get('domain') == 'category':
+                post['categories'].append(cl)
+            else:
+                # tags are the most general sort of classifier we've got
+                # access to
+                post['tags'].append(cl)
+
+        return post
+
+############################################################################
+# the pipeline, one stage at a time. To run all of them with the same
+# options (comments have to get from the importer to the exporter), use
+# Exporter.pipeline() instead.
+def _closing(exporter, items):
+    """Yield ``items``, and close ``exporter`` once they've run out (or
+    nobody wants any more)"""
+    try:
+        for item in items:
+            yield item
+    finally:
+        exporter.close()
+
+def iter_posts(source, source_format='wp_rss', **options):
+    """Lazily yield the posts in ``source``
+
+    ``options`` are ``Exporter``'s keyword arguments (``post_filter``,
+    ``revisions``...).
+    """
+    exporter = Exporter.pipeline(**options)
+    return _closing(exporter, exporter.iter_posts(source, source_format))
+
+def iter_converted(posts, dest_format='pelican', **options):
+    """Lazily convert the content of ``posts`` to markdown for
+    ``dest_format`` (``jobs``, ``cache``...)"""
+    exporter = Exporter.pipeline(dest_format, **options)
+    return _closing(exporter, exporter.iter_converted(posts))
+
+def iter_rendered(posts, dest_format='pelican', **options):
+    """Lazily render converted ``posts`` as ``dest_format`` files, yielding
+    ``(relative filename, utf-8 bytes)`` for each of them"""
+    exporter = Exporter.pipeline(dest_format, **options)
+    return _closing(exporter, exporter.iter_rendered(posts))
+
+############################################################################
+# wp-md serve: a long-running wp-md that takes jobs as lines of json
+
+# upper bounds of the buckets of a LatencyHistogram, in milliseconds
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                   10000, 30000, 60000)
+
+class LatencyHistogram(object):
+    """Counts how long requests took, in ``LATENCY_BUCKETS``
+
+    Percentiles are the upper bound of the bucket that they fall into,
+    which is as precise as a histogram gets. Requests are added from
+    several threads at once.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        with self.lock:
+            self.counts[bisect.bisect_left(LATENCY_BUCKETS, ms)] += 1
+            self.n += 1
+            self.total += ms
+            self.max = max(self.max, ms)
+
+    def percentile(self, fraction):
+        """The bucket bound that ``fraction`` of the requests were under"""
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (None,), self.counts):
+            seen += count
+            if seen >= fraction * self.n:
+                return bound if bound is not None else round(self.max, 3)
+        return 0
+
+    def report(self):
+        buckets = OrderedDict()
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            buckets['<=%d' % bound] = count
+        buckets['>%d' % LATENCY_BUCKETS[-1]] = self.counts[-1]
+        return OrderedDict([
+            ('requests', self.n),
+            ('mean_ms', round(self.total / self.n, 3) if self.n else 0),
+            ('max_ms', round(self.max, 3)),
+            ('p50_ms', self.percentile(0.5)),
+            ('p90_ms', self.percentile(0.9)),
+            ('p99_ms', self.percentile(0.99)),
+            ('buckets', buckets)])
+
+    def summary(self, name):
+        report = self.report()
+        return ('%-8s %7d requests, mean %.1f ms, p50 <= %s ms, p90 <= %s '
+                'ms, p99 <= %s ms, max %.1f ms\n'
+                % (name, report['requests'], report['mean_ms'],
+                   report['p50_ms'], report['p90_ms'], report['p99_ms'],
+                   report['max_ms']))
+
+class SharedCache(object):
+    """A ``ConversionCache`` for every request that a server handles
+
+    Requests are handled on several threads, which take turns with it.
+    Exporters close their cache when they're done, which only commits
+    this one: it stays open until ``shutdown``.
+    """
+    key = staticmethod(ConversionCache.key)
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=256 * 1024 * 1024):
+        self.cache = ConversionCache(cache_dir, max_bytes,
+                                     check_same_thread=False)
+        self.lock = threading.Lock()
+
+    hits = property(lambda self: self.cache.hits)
+    misses = property(lambda self: self.cache.misses)
+
+    def get(self, key):
+        with self.lock:
+            return self.cache.get(key)
+
+    def put(self, key, markdown):
+        with self.lock:
+            self.cache.put(key, markdown)
+
+    def close(self):
+        with self.lock:
+            self.cache.db.commit()
+
+    def shutdown(self):
+        with self.lock:
+            self.cache.close()
+
+# the options of an export job -> the PostFilter argument that they become
+SERVE_FILTERS = ('since', 'until', 'statuses', 'post_types', 'authors',
+                 'classifiers', 'ids')
+# ...and the ones that go to the Exporter
+SERVE_OPTIONS = ('jobs', 'parse_jobs', 'revisions', 'comments',
+                 'incremental', 'keep_html', 'max_inflight_bytes')
+# what a post in a render job gets if it doesn't say
+SERVE_POST_DEFAULTS = {'author': u'', 'status': u'publish',
+                       'post_type': u'post', 'tags': [], 'categories': [],
+                       'classifiers': []}
+
+class Server(object):
+    """Runs conversion jobs for ``wp-md serve``, without starting up wp-md
+    for every one of them
+
+    Every request is a line with a json object, and gets a line with a
+    json object back, with the request's ``id`` (whatever it is) and
+    ``ok``. What a request wants is its ``op``, each of which is a
+    ``do_OP`` method:
+
+        - ``convert``: ``html`` -> ``markdown``
+        - ``render``: a ``post`` (title, date, content...) -> its ``files``
+        - ``export``: a ``source`` -> ``files``, or written into ``dest``
+        - ``stats``: the request latency histograms
+
+    Left out, the op is 'convert' if there's ``html``, 'render' if there's
+    a ``post`` and 'export' if there's a ``source``. Requests that fail get
+    ``ok: false`` and an ``error``.
+
+    Requests are handled by ``concurrency`` threads, and more of them than
+    that only wait their turn, so that's how many conversions (and open
+    files, and posts in memory) there can be at once. Responses go out as
+    soon as they're done, not necessarily in the order the requests came
+    in. Each thread keeps an exporter per output format, and all of them
+    share ``cache``.
+    """
+    def __init__(self, concurrency=4, cache=None,
+                 exporter_class=Exporter):
+        self.cache = cache
+        self.exporter_class = exporter_class
+        self.latency = OrderedDict([('all', LatencyHistogram())])
+        self.latency_lock = threading.Lock()
+        self.local = threading.local()
+        self.requests = Queue.Queue(concurrency * PENDING_PER_JOB)
+        self.threads = []
+        for _ in xrange(concurrency):
+            thread = threading.Thread(target=self._worker,
+                                      name='wp-md server')
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _worker(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            line, received, respond = item
+            op, response = self.handle(line)
+            self._latency(op).add(time.time() - received)
+            self.latency['all'].add(time.time() - received)
+            respond(response)
+
+    def _latency(self, op):
+        with self.latency_lock:
+            if op not in self.latency:
+                self.latency[op] = LatencyHistogram()
+            return self.latency[op]
+
+    def submit(self, line, respond):
+        """Queue up a request, ``respond`` gets called with the response
+        line (from some other thread)"""
+        self.requests.put((line, time.time(), respond))
+
+    def handle(self, line):
+        """Run the request in ``line``, returning its op and the response"""
+        op = 'invalid'
+        response = OrderedDict([('id', None), ('ok', True)])
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("a request has to be a json object")
+            response['id'] = request.get('id')
+            op = request.get('op') or ('html' in request and 'convert' or
+                                       'post' in request and 'render' or
+                                       'source' in request and 'export')
+            if not op:
+                raise ValueError("what's this? no op, html, post or source")
+            method = getattr(self, 'do_%s' % op, None)
+            if method is None:
+                raise ValueError("unknown op: %s" % op)
+            response.update(method(request))
+        except Exception as e:
+            response['ok'] = False
+            response['error'] = '%s: %s' % (type(e).__name__, e)
+        return op, json.dumps(response) + '\n'
+
+    def _exporter(self, dest_format):
+        """This thread's warm exporter for ``dest_format``"""
+        exporters = getattr(self.local, 'exporters', None)
+        if exporters is None:
+            exporters = self.local.exporters = {}
+        if dest_format not in exporters:
+            exporters[dest_format] = self.exporter_class.pipeline(
+                dest_format, cache=self.cache)
+        exporter = exporters[dest_format]
+        # every request names its files on its own
+        exporter.stems = {}
+        return exporter
+
+    @staticmethod
+    def _files(rendered):
+        return [{'filename': filename, 'content': data.decode('utf-8')}
+                for filename, data in rendered]
+
+    def do_convert(self, request):
+        exporter = self._exporter(request.get('output_format', 'pelican'))
+        post = Post(content=request['html'])
+        exporter.iter_converted([post]).next()
+        return {'markdown': post[u'content']}
+
+    def do_render(self, request):
+        exporter = self._exporter(request.get('output_format', 'pelican'))
+        post = Post()
+        for key, value in SERVE_POST_DEFAULTS.iteritems():
+            # exporters can mangle the lists
+            post[key] = list(value) if isinstance(value, list) else value
+        post.update(request['post'])
+        return {'files': self._files(exporter.iter_rendered(
+            exporter.iter_converted([post])))}
+
+    def do_export(self, request):
+        options = dict((name, request[name]) for name in SERVE_OPTIONS
+                       if name in request)
+        options['post_filter'] = PostFilter(**dict(
+            (name, request[name]) for name in SERVE_FILTERS
+            if name in request))
+        source = request['source']
+        source_format = request.get('input_format', 'wp_rss')
+        dest_format = request.get('output_format', 'pelican')
+        dest = request.get('dest')
+        if dest is None:
+            exporter = self.exporter_class.pipeline(
+                dest_format, cache=self.cache, **options)
             try:
-                term = all_tags[term_id] # should throw KeyError for links
-                post_classifiers[obj_id].append(term)
-            except KeyError:
-                pass
+                files = self._files(exporter.iter_rendered(
+                    exporter.iter_converted(
+                        exporter.iter_posts(source, source_format))))
+            finally:
+                exporter.close()
+            return {'files': files}
+        if dest_format != 'jsonl' and not os.path.isdir(dest):
+            os.makedirs(dest)
+        exporter = self.exporter_class(
+            source, dest, source_format, dest_format,
+            prune=request.get('prune', False), cache=self.cache,
+            progress='quiet', **options)
+        return {'files_written': exporter.files_written}
+
+    def do_stats(self, request):
+        with self.latency_lock:
+            latency = self.latency.items()
+        return {'latency': OrderedDict((op, histogram.report())
+                                       for op, histogram in latency)}
+
+    def serve_stream(self, infile, outfile):
+        """Answer the requests that come in on ``infile`` (a line each) on
+        ``outfile``, until ``infile`` runs out and every one of them has
+        been answered"""
+        lock = threading.Condition()
+        pending = [0]
+        def respond(response):
+            with lock:
+                try:
+                    outfile.write(response)
+                    outfile.flush()
+                except (IOError, socket.error):
+                    # whoever asked isn't listening anymore
+                    pass
+                pending[0] -= 1
+                lock.notify_all()
+        # not ``for line in infile``, which reads ahead
+        for line in iter(infile.readline, ''):
+            if not line.strip():
+                continue
+            with lock:
+                pending[0] += 1
+            self.submit(line, respond)
+        with lock:
+            while pending[0]:
+                lock.wait(0xFFFF)
+
+    def serve_socket(self, path):
+        """Listen on a unix socket at ``path``, every connection is a stream
+        of requests like stdin would be, until we get interrupted"""
+        server_self = self
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                server_self.serve_stream(self.rfile, self.wfile)
+        if os.path.exists(path):
+            os.remove(path)
+        server = SocketServer.ThreadingUnixStreamServer(path, Handler)
+        server.daemon_threads = True
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(path)
+
+    def close(self):
+        """Finish whatever's queued up, and let go of the cache"""
+        for _ in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join(0xFFFF)
+        if self.cache is not None:
+            self.cache.shutdown()
+
+    def summary(self):
+        with self.latency_lock:
+            latency = self.latency.items()
+        return ''.join(histogram.summary(op) for op, histogram in latency
+                       if histogram.n)
+
+############################################################################
+# --watch: keeping an export up to date with its sources
+
+# how often --watch looks at the sources (with inotify it's only a backstop)
+WATCH_INTERVAL = 2.0
+# and how long they have to stay the same before they're read, so that a
+# file that is still being copied into place doesn't get exported
+WATCH_SETTLE = 1.0
+
+class _Inotify(object):
+    """Just enough of inotify (through ctypes) to wake up when files in
+    some directories are written, created, moved or deleted
+
+    The events themselves aren't looked at, ``Watcher`` compares the files
+    afterwards anyway. ``open()`` returns None where there's no inotify.
+    """
+    # IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    MASK = 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    @classmethod
+    def open(cls, directories):
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                               use_errno=True)
+            fd = libc.inotify_init()
+        except (ImportError, OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        for directory in directories:
+            if libc.inotify_add_watch(fd, directory, cls.MASK) < 0:
+                os.close(fd)
+                return None
+        return cls(fd)
+
+    def wait(self, timeout):
+        """Wait up to ``timeout`` seconds for something to happen"""
+        if select.select([self.fd], [], [], timeout)[0]:
+            os.read(self.fd, 64 * 1024)
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher(object):
+    """Keeps an incremental export up to date with its sources, for
+    ``--watch``
+
+    The sources are exported once, and then again every time that they
+    change (they're replaced, or a folder gets another file): with inotify
+    if there is one, by looking at them every ``interval`` seconds if not.
+    The ``Manifest`` of every post's id, hash and files is kept from one
+    export to the next, so only posts that were added or changed get
+    converted and written, and the files of posts that are gone get
+    reported (or deleted, with ``prune``).
+
+    ``sources`` are the sources as they were given, files, folders and
+    globs, which are looked at again every time. ``new_sink`` makes the
+    sink for an export (every export closes its own), and the rest of
+    ``options`` go to ``Exporter.pipeline``. Exporters close their cache
+    when they're done, so it should be a ``SharedCache``.
+    """
+    def __init__(self, sources, outdir, source_format='wp_rss',
+                 dest_format='pelican', prune=False, interval=WATCH_INTERVAL,
+                 new_sink=None, exporter_class=Exporter, **options):
+        self.sources = sources
+        self.outdir = outdir
+        self.source_format = source_format
+        self.dest_format = dest_format
+        self.prune = prune
+        self.interval = interval
+        self.new_sink = new_sink
+        self.exporter_class = exporter_class
+        self.options = options
+        # the post index, carried over from export to export
+        self.manifest = Manifest(outdir, dest_format)
+        # what the files looked like when they were last exported
+        self.signature = None
+        self.inotify = _Inotify.open(self._directories())
+
+    def _directories(self):
+        directories = set()
+        for source in self.sources:
+            if not os.path.isdir(source):
+                source = os.path.dirname(source) or os.curdir
+            if os.path.isdir(source):
+                directories.add(source)
+        return sorted(directories)
 
+    def look(self):
+        """The files that the sources are now, and their signature, or
+        ``(None, None)`` if they're not all there"""
+        try:
+            files = _expand_sources(self.sources, self.source_format)
+        except SystemExit:
+            # an empty folder, or a glob that doesn't match anything yet
+            return None, None
+        signature = []
+        for filename in files:
             try:
-                # throw keyerror if this post doesn't have a category
-                cat = categories[term_id]
-                post_cats[obj_id].append(cat)
-            except KeyError:
-                pass
+                st = os.stat(filename)
+            except OSError:
+                return None, None
+            signature.append((filename, st.st_ino, st.st_size, st.st_mtime))
+        return files, signature
+
+    def wait(self):
+        """Wait for the sources to change and settle down again, and return
+        the files"""
+        while True:
+            if self.inotify is not None:
+                self.inotify.wait(self.interval)
+            else:
+                time.sleep(self.interval)
+            files, signature = self.look()
+            if signature is None or signature == self.signature:
+                continue
+            while True:
+                time.sleep(WATCH_SETTLE)
+                files, again = self.look()
+                if again == signature:
+                    return files
+                if again is None:
+                    break
+                signature = again
 
+    def export(self, files):
+        """Export ``files``, as far as they've changed since last time"""
+        self.signature = self.look()[1]
+        post_filter = self.options.get('post_filter')
+        if post_filter is not None:
+            post_filter.rejected = OrderedDict()
+        sink = self.new_sink() if self.new_sink is not None else None
+        exporter = self.exporter_class.pipeline(
+            self.dest_format, outdir=self.outdir, sink=sink, **self.options)
+        exporter.manifest = self.manifest
+        exporter.stems = self.manifest.stems()
+        try:
+            exporter.export(files, self.source_format, self.prune)
+        except Exception:
+            self.manifest.abandon()
             try:
-                # throw keyerror if this post doesn't have this tag
-                tag = taxes[term_id]
-                post_tags[obj_id].append(tag)
-            except KeyError:
+                # finish writing whatever was rendered
+                exporter.sink.close()
+            except Exception:
                 pass
+            raise
 
-        for el in els:
-            id = el.find("./column[@name='ID']").text
-            author_id = el.find("./column[@name='post_author']").text
-            author = users[author_id]
-            post_type = el.find("./column[@name='post_type']").text
-            status = el.find("./column[@name='post_status']").text
-            if post_type == 'revision':
-                id = el.find("./column[@name='post_parent']").text
-                if status == u'inherit':
-                    status = posts[id][u'status']
-
-            posts[id] = {
-                u'date':    el.find("./column[@name='post_date']").text,
-                u'author':  author,
-                u'content': el.find("./column[@name='post_content']").text,
-                u'title':   el.find("./column[@name='post_title']").text,
-                u'status':  status,
-                u'classifiers':    post_classifiers[id],
-                u'categories': post_cats[id],
-                u'tags': post_tags[id],
-                }
-
-        return posts.itervalues()
+    def run(self):
+        """Export, and then keep exporting, until we're interrupted"""
+        files = _expand_sources(self.sources, self.source_format)
+        how = 'inotify' if self.inotify is not None else \
+              'looking every %gs' % self.interval
+        while True:
+            try:
+                self.export(files)
+            except Exception as e:
+                sys.stderr.write("export failed, waiting for the sources "
+                                 "to change again: %s: %s\n"
+                                 % (type(e).__name__, e))
+            sys.stderr.write("watching %d files for changes (%s)\n"
+                             % (len(files), how))
+            files = self.wait()
+            sys.stderr.write("the sources changed, exporting again\n")
 
-    @staticmethod
-    def get_posts_from_wp_rss(filename):
-        rss = ET.parse(filename).getroot()
-
-        # namespaced elements are expanded according to xml rules to look
-        # like '{long/namespace}element', and for some reasona I can't create
-        # a name mapping inside of etree to allow me to access e.g.
-        # wp:element elements. Hence these namespace functions.
-        def wp(element):
-            return u'{http://wordpress.org/export/1.1/}%s' % element
-        def dc(element):
-            return u'{http://purl.org/dc/elements/1.1/}%s' % element
-        def content(el):
-            return u'{http://purl.org/rss/1.0/modules/content/}%s' % el
-
-        for post_el in rss.findall('channel/item'):
-            post = {}
-            post['date']  = post_el.find(wp('post_date')).text
-            post['author'] = post_el.find(dc('creator')).text
-            post['content'] = post_el.find(content('encoded')).text
-            post['title'] = post_el.find('title').text
-            post['status'] = post_el.find(wp('status')).text
-            post['categories'] = []
-            post['tags'] = []
-            post['classifiers'] = []
-            for classifier in post_el.findall('category'):
-                cl = classifier.text
-                post['classifiers'].append(cl)
-                if classifier.get('domain') == 'category':
-                    post['categories'].append(cl)
-                else:
-                    # tags are the most general sort of classifier we've got
-                    # access to
-                    post['tags'].append(cl)
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
 
-            yield post
+def _date_arg(value):
+    if not re.match(r'^\d{4}(-\d\d(-\d\d( \d\d(:\d\d(:\d\d)?)?)?)?)?$',
+                    value):
+        raise argparse.ArgumentTypeError(
+            "%r doesn't look like YYYY-MM-DD[ HH:MM[:SS]]" % value)
+    return value
+
+def _list_arg(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+def _bytes_arg(value):
+    match = re.match(r'^(\d+)([kmg]?)b?$', value.strip().lower())
+    if not match:
+        raise argparse.ArgumentTypeError(
+            "%r isn't a number of bytes, like 500000 or 64M" % value)
+    return int(match.group(1)) * 1024 ** ' kmg'.index(match.group(2) or ' ')
+
+# what's looked for when a source is a folder: files with the extension of
+# the input format, compressed or not
+SOURCE_EXTENSIONS = {'wp_rss': '.xml', 'pma_xml': '.xml', 'sql': '.sql'}
+COMPRESSED_SUFFIXES = ('', '.gz', '.bz2', '.xz', '.zst')
+
+def _natural_key(path):
+    """Sort key that puts ``export.2.xml`` before ``export.10.xml``"""
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r'(\d+)', path)]
+
+def _expand_sources(sources, input_format='wp_rss'):
+    """The files that the command line's sources mean
+
+    Folders stand for the files of ``input_format`` inside of them (all
+    of the ``.xml`` files, say), and globs are expanded
+    for shells that didn't (or couldn't, because they were quoted). Either
+    way the files come out sorted with numbers compared as numbers, which
+    is the order that WordPress' split exports are numbered in.
+    """
+    files = []
+    for source in sources:
+        if os.path.isdir(source):
+            extension = SOURCE_EXTENSIONS[input_format]
+            found = [path for suffix in COMPRESSED_SUFFIXES
+                     for path in glob.glob(os.path.join(
+                         source, '*' + extension + suffix))]
+            if not found:
+                exit("There are no %s files in %s." % (extension, source))
+        elif source != '-' and not os.path.exists(source) and \
+                glob.has_magic(source):
+            found = glob.glob(source)
+            if not found:
+                exit("Nothing matches %s." % source)
+        else:
+            files.append(source)
+            continue
+        files.extend(sorted(found, key=_natural_key))
+    if '-' in files and len(files) > 1:
+        exit("stdin (-) has to be the only source.")
+    return files
 
 def parse_args(args):
     parser = argparse.ArgumentParser(
+        usage="%(prog)s [options] <blog.xml> [<blog.xml> ...] "
+        "<output_folder>\n"
+        "       %(prog)s --plan [options] <blog.xml> [<blog.xml> ...]\n"
+        "       %(prog)s serve [options]",
         description="Convert WordPress data from on giant xml file into a "
         "bunch of Markdown files.",
         epilog="""The defaults have been chosen to be commonly useful if you
@@ -469,42 +4178,357 @@ def parse_args(args):
         destination`` and you'll end up with a bunch of files named after
         your blog titles. Home Page: http://github.com/quodlibetor/wp-md""")
 
-    parser.add_argument('source', metavar="<blog.xml>",
-                        help="The file to convert")
-    parser.add_argument('dest', metavar="<output_folder>",
-                        help="The folder to put the converted files in")
+    # the destination is the last of these, see below
+    parser.add_argument('source', metavar="<blog.xml> <output_folder>",
+                        nargs='+',
+                        help="The file to convert, - for stdin. It can be "
+                        "compressed with gzip, bzip2, xz or zstd. Give more "
+                        "than one (or a folder, or a quoted glob) to convert "
+                        "a split export. A file called serve has to be "
+                        "given as ./serve, `%(prog)s serve` starts a server. "
+                        "Then the folder to put the converted files in, "
+                        "the archive with --archive, or the file (- for "
+                        "stdout) with --of jsonl. There isn't one with "
+                        "--plan.")
     parser.add_argument('--of', "--output-format",
-                        choices=("pelican", "nikola", "mynt"),
+                        choices=("pelican", "nikola", "mynt", "jsonl"),
                         default="pelican",
                         dest="output_format",
                         help="The output format. These match the data formats"
-                        " expected by the named static site generators.")
+                        " expected by the named static site generators, "
+                        "except for jsonl, which is a line of json for every "
+                        "post.")
     parser.add_argument('--if', "--input-format",
-                        choices=("pma_xml", "wp_rss"),
+                        choices=("pma_xml", "sql", "wp_rss"),
                         default='wp_rss',
                         dest="input_format",
-                        help="The input format: either PHPMyAdmin xml "
-                        "or WordPress eXtended RSS (v1.1). If you are "
+                        help="The input format: PHPMyAdmin xml, a mysqldump "
+                        "(sql) or WordPress eXtended RSS (v1.1). If you are "
                         "unsure which one you have it's probably wp_rss."
                         )
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        metavar='N',
+                        help="Convert posts to markdown using N processes. "
+                        "0 means one process per CPU. (Default: 1)")
+    parser.add_argument('--parse-jobs', type=int, default=1, metavar='N',
+                        help="Parse a (wp_rss, uncompressed) file with N "
+                        "processes, 0 means one per CPU. Default: "
+                        "%(default)s")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Keep a manifest in the output folder and only "
+                        "convert and write posts that have changed since "
+                        "the last incremental export into it.")
+    parser.add_argument('--watch', action='store_true',
+                        help="Implies --incremental. Keep running after the "
+                        "export, and export the posts that were added, "
+                        "changed or removed every time that the sources "
+                        "change.")
+    parser.add_argument('--watch-interval', type=float,
+                        default=WATCH_INTERVAL, metavar='<seconds>',
+                        help="How often --watch looks at the sources when "
+                        "there's no inotify. Default: %(default)s")
+    parser.add_argument('--prune', action='store_true',
+                        help="Implies --incremental. Delete the files of "
+                        "posts that are gone from the source, instead of "
+                        "just reporting them.")
+    parser.add_argument('--archive', choices=ARCHIVE_FORMATS.keys(),
+                        help="Write everything into a single archive "
+                        "instead of a folder. The destination is the "
+                        "archive's file name, or - to stream a tar to "
+                        "stdout.")
+    parser.add_argument('--max-inflight-bytes', type=_bytes_arg,
+                        metavar='<size>',
+                        help="Stop reading the source while this much post "
+                        "content (e.g. 64M) is waiting to be converted or "
+                        "written, and keep the content of pma_xml and sql "
+                        "dumps in a temporary file until it's needed. "
+                        "Default: no limit")
+    parser.add_argument('--write-threads', type=int, default=2,
+                        metavar='N',
+                        help="Write files from N background threads while "
+                        "the next posts are being converted, 0 writes them "
+                        "as they're rendered. Archives get one thread. "
+                        "Default: %(default)s")
+    parser.add_argument('--atomic', action='store_true',
+                        help="Write every file to a temporary name and "
+                        "rename it into place.")
+    parser.add_argument('--fsync', choices=FSYNC_POLICIES, default='none',
+                        help="Make sure the files are on disk: after each "
+                        "one, or all of them at the end. Default: "
+                        "%(default)s")
+    parser.add_argument('--progress', choices=PROGRESS_MODES,
+                        default='lines',
+                        help="Print a line for every file, a count every "
+                        "%d files, or nothing. Default: %%(default)s"
+                        % PROGRESS_BATCH)
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help="Don't use the conversion cache, which "
+                        "remembers the markdown for html that has been "
+                        "converted before.")
+    parser.add_argument('--clear-cache', action='store_true',
+                        help="Empty the conversion cache before starting.")
+    parser.add_argument('--cache-dir', default=CACHE_DIR, metavar='<dir>',
+                        help="Where to keep the conversion cache. "
+                        "Default: %(default)s")
+    parser.add_argument('--cache-size', type=int, default=256, metavar='<MB>',
+                        help="Throw out the least recently used "
+                        "conversions when the cache grows past this. "
+                        "Default: %(default)s")
+    filters = parser.add_argument_group(
+        'filters', "Only export some of the posts. Options that take a list "
+        "take a comma-separated one, and can be given more than once.")
+    filters.add_argument('--since', type=_date_arg, metavar='<date>',
+                         help="Only posts from this date (YYYY-MM-DD, "
+                         "optionally with a time) or later.")
+    filters.add_argument('--until', type=_date_arg, metavar='<date>',
+                         help="Only posts from this date or earlier, "
+                         "including the whole day.")
+    filters.add_argument('--status', type=_list_arg, action='append',
+                         default=[], metavar='<list>',
+                         help="Only posts with one of these WordPress "
+                         "statuses, e.g. publish,draft")
+    filters.add_argument('--post-type', type=_list_arg, action='append',
+                         default=[], metavar='<list>',
+                         help="Only these types of posts, e.g. post,page")
+    filters.add_argument('--author', type=_list_arg, action='append',
+                         default=[], metavar='<list>',
+                         help="Only posts by these authors (display names).")
+    filters.add_argument('--classifier', type=_list_arg, action='append',
+                         default=[], metavar='<list>',
+                         help="Only posts with at least one of these tags "
+                         "or categories.")
+    filters.add_argument('--include-ids', type=_list_arg, action='append',
+                         default=[], metavar='<list>',
+                         help="Only the posts with these ids.")
+    parser.add_argument('--revisions', choices=['latest', 'all'],
+                        default='latest',
+                        help="With pma_xml and sql, posts get the content of "
+                        "their newest revision. 'all' also writes every "
+                        "revision out as a draft next to its post.")
+    parser.add_argument('--comments', action='store_true',
+                        help="Also write the approved comments of every post "
+                        "to a <post>.comments.json file next to it (or into "
+                        "its jsonl record).")
+    parser.add_argument('--keep-html', action='store_true',
+                        help="With --of jsonl, put every post's original "
+                        "html into its record as well.")
+    parser.add_argument('--stats', action='store_true',
+                        help="Print how much time and cpu every stage of the "
+                        "conversion took when it's done.")
+    parser.add_argument('--stats-json', metavar='<report.json>',
+                        help="Write those stats to a json file.")
+    parser.add_argument('--plan', action='store_true',
+                        help="Don't convert anything, just count what's in "
+                        "the source (posts by status and type, content "
+                        "size, the largest posts, <pre lang> languages) "
+                        "and print that, for sizing up --jobs and memory.")
+    parser.add_argument('--plan-json', metavar='<plan.json>',
+                        help="Implies --plan. Write the counts to a json "
+                        "file as well.")
+    parser.add_argument('--profile', metavar='<profile.out>',
+                        help="Run the conversion under cProfile and dump the "
+                        "stats to this file, for `python -m pstats`. Worker "
+                        "processes from --jobs and the thread that reads the "
+                        "source aren't profiled.")
     parser.add_argument('--version',
                         action='version',
                         version='%(prog)s ' + VERSION)
 
 
+    # argparse only hands the first run of paths to 'source', so the ones
+    # after an option (blog.xml --of mynt blog-files) are left over
+    args, rest = parser.parse_known_args(args[1:])
+    unknown = [arg for arg in rest if arg.startswith('-') and arg != '-']
+    if unknown:
+        parser.error("unrecognized arguments: %s" % ' '.join(unknown))
+    args.source.extend(rest)
+    args.plan = args.plan or bool(args.plan_json)
+    # dest can't be told apart from the sources until we know whether there
+    # is one
+    args.dest = None
+    if not args.plan:
+        if len(args.source) < 2:
+            parser.error("too few arguments")
+        args.dest = args.source.pop()
+    return args
+
+def parse_serve_args(args):
+    parser = argparse.ArgumentParser(
+        prog='wp-md serve',
+        description="Keep wp-md running and convert posts (or whole "
+        "exports) as they're asked for, a line of json per request and per "
+        "response.",
+        epilog="""Requests look like {"id": 1, "html": "<p>hi</p>",
+        "output_format": "pelican"} (see wpmd.Server for the rest), and
+        {"op": "stats"} gets the latency histograms.""")
+    parser.add_argument('--socket', metavar='<path>',
+                        help="Listen on a unix socket here, instead of "
+                        "reading requests from stdin and answering on "
+                        "stdout.")
+    parser.add_argument('--concurrency', type=int, default=4, metavar='N',
+                        help="Handle up to N requests at once, the rest "
+                        "wait. Default: %(default)s")
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help="Don't use the conversion cache.")
+    parser.add_argument('--cache-dir', default=CACHE_DIR, metavar='<dir>',
+                        help="Where to keep the conversion cache. "
+                        "Default: %(default)s")
+    parser.add_argument('--cache-size', type=int, default=256, metavar='<MB>',
+                        help="Throw out the least recently used "
+                        "conversions when the cache grows past this. "
+                        "Default: %(default)s")
     return parser.parse_args(args[1:])
 
+def serve(argv):
+    args = parse_serve_args(argv)
+    if args.concurrency < 1:
+        exit("--concurrency has to be at least 1.")
+    cache = None
+    if args.cache:
+        cache = SharedCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    server = Server(args.concurrency, cache)
+    def interrupted(signum, frame):
+        raise KeyboardInterrupt
+    # service managers stop us with SIGTERM, which is as good as ctrl-c
+    signal.signal(signal.SIGTERM, interrupted)
+    try:
+        if args.socket:
+            server.serve_socket(args.socket)
+        else:
+            server.serve_stream(sys.stdin, sys.stdout)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        sys.stderr.write(server.summary())
+
 def main():
+    # a source that's called serve has to be given as ./serve
+    if sys.argv[1:2] == ['serve']:
+        return serve(sys.argv[1:])
     args = parse_args(sys.argv)
+    sources = _expand_sources(args.source, args.input_format)
+
+    if args.plan:
+        jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+        plan = Plan(args.input_format).scan(sources)
+        sys.stdout.write(plan.summary(jobs).encode('utf-8'))
+        if args.plan_json:
+            with open(args.plan_json, 'w') as fh:
+                json.dump(plan.report(jobs), fh, indent=2)
+        return
 
-    if not os.path.isdir(args.dest):
+    if args.watch and '-' in sources:
+        exit("--watch needs files to watch, not stdin.")
+    incremental = args.incremental or args.prune or args.watch
+    if args.archive:
+        if incremental:
+            exit("--incremental only works when writing to a folder.")
+        if args.dest == '-' and args.archive == 'zip':
+            exit("Zip archives can't be streamed, give them a file name.")
+        if os.path.isdir(args.dest):
+            exit("With --archive, the destination is the archive's name.")
+    elif args.output_format == 'jsonl':
+        if incremental:
+            exit("--incremental only works when writing to a folder.")
+        if os.path.isdir(args.dest):
+            exit("With --of jsonl, the destination is a file, or - for "
+                 "stdout.")
+    elif not os.path.isdir(args.dest):
         if os.path.exists(args.dest):
             exit("Destination should be a directory, not a file.")
 
         os.makedirs(args.dest)
 
-    Exporter(args.source, args.dest,
-             args.input_format, args.output_format)
+    def new_sink():
+        # --watch needs a new one for every export
+        if args.archive:
+            sink = ARCHIVE_FORMATS[args.archive](args.dest, fsync=args.fsync)
+        elif args.output_format == 'jsonl':
+            sink = StreamSink(args.dest, fsync=args.fsync)
+        else:
+            sink = DirectorySink(args.dest, atomic=args.atomic,
+                                 fsync=args.fsync)
+        if args.write_threads > 0:
+            sink = ThreadedSink(sink, args.write_threads)
+        return sink
+
+    stats = None
+    if args.stats or args.stats_json:
+        stats = Stats(STAGES)
+
+    flatten = lambda lists: [item for items in lists for item in items]
+    post_filter = PostFilter(since=args.since, until=args.until,
+                             statuses=flatten(args.status),
+                             post_types=flatten(args.post_type),
+                             authors=flatten(args.author),
+                             classifiers=flatten(args.classifier),
+                             ids=flatten(args.include_ids))
+
+    cache = None
+    if args.cache or args.clear_cache:
+        cache = ConversionCache(args.cache_dir, args.cache_size * 1024 * 1024)
+        if args.clear_cache:
+            cache.clear()
+        if not args.cache:
+            cache.close()
+            cache = None
+    if cache is not None and args.watch:
+        # every export closes its cache, which only commits a shared one
+        cache.close()
+        cache = SharedCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+    options = dict(jobs=args.jobs, parse_jobs=args.parse_jobs, stats=stats,
+                   revisions=args.revisions, cache=cache,
+                   progress=args.progress, post_filter=post_filter,
+                   comments=args.comments, keep_html=args.keep_html,
+                   max_inflight_bytes=args.max_inflight_bytes)
+    if args.watch:
+        watcher = Watcher(args.source, args.dest, args.input_format,
+                          args.output_format, prune=args.prune,
+                          interval=args.watch_interval, new_sink=new_sink,
+                          **options)
+        def export():
+            def interrupted(signum, frame):
+                raise KeyboardInterrupt
+            signal.signal(signal.SIGTERM, interrupted)
+            try:
+                watcher.run()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                watcher.close()
+                if cache is not None:
+                    cache.shutdown()
+    else:
+        export = lambda: Exporter(sources, args.dest,
+                                  args.input_format, args.output_format,
+                                  incremental=incremental, prune=args.prune,
+                                  sink=new_sink(), **options)
+    try:
+        if args.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(export)
+            finally:
+                profiler.dump_stats(args.profile)
+        else:
+            export()
+    except IOError as e:
+        if e.errno != errno.EPIPE or args.dest != '-':
+            raise
+        # whatever was reading stdout (| head, say) has had enough, go away
+        # as quietly as the default SIGPIPE handling would have, without
+        # python complaining about flushing stdout on the way out
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(128 + signal.SIGPIPE)
+
+    if args.stats:
+        sys.stderr.write(stats.summary())
+    if args.stats_json:
+        with open(args.stats_json, 'w') as fh:
+            json.dump(stats.report(), fh, indent=2)
 
 if __name__ == '__main__':
     main()